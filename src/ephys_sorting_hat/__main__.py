@@ -1,11 +1,14 @@
+import argparse
 import sys
+import time
 import matplotlib
 import matplotlib.pyplot as plt
 import re
 import numpy as np
 import pandas as pd
+import pyabf
 
-from ephys_sorting_hat.model import Model, SignalGroup, Sweep
+from ephys_sorting_hat.model import DETECTORS, FolderWatcher, Model, SignalGroup, Sweep, abf_sample_count, pass_filter
 from matplotlib.figure import Figure
 from PyQt6 import QtGui
 from PyQt6 import QtCore
@@ -19,20 +22,18 @@ from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg, NavigationToolb
 
 LOAD_LABEL_WIDTH = 120
 SAVE_LABEL_WIDTH = 120
-
-def pass_filter(data, lowband, upperband, sample_rate):
-    upperband_index = int(upperband * data.size / sample_rate)
-    fsig = np.fft.fft(data)
-    for i in range(upperband_index + 1, len(fsig) - upperband_index):
-        fsig[i] = 0
-
-    lowband_index = int(lowband * data.shape[0] / sample_rate)
-    for i in range(lowband_index):
-        fsig[i] = 0
-        fsig[len(fsig)-i-1] = 0
-
-    data_filtered = np.fft.ifft(fsig)
-    return np.real(data_filtered)
+WATCH_INTERVAL_MS = 2000
+MEMORY_INTERVAL_MS = 1000
+
+def format_memory_stats(stats):
+    mb = lambda x: f"{x / 2**20:.0f} MB"
+    text = f"Sweeps in memory: {mb(stats['resident_bytes'])} (peak {mb(stats['peak_resident_bytes'])}"
+    if stats['budget_bytes'] is not None:
+        text += f", budget {mb(stats['budget_bytes'])}"
+    text += f"), {stats['evictions']} evictions, {stats['reloads']} reloads"
+    if 'peak_process_bytes' in stats:
+        text += f", process peak {mb(stats['peak_process_bytes'])}"
+    return text
 
 class LoadFileLayout(QtWidgets.QHBoxLayout):
     load_file_event = QtCore.pyqtSignal()
@@ -49,6 +50,9 @@ class LoadFileLayout(QtWidgets.QHBoxLayout):
         browse.setFixedWidth(100)
         load = QtWidgets.QPushButton("Load")
         load.setFixedWidth(100)
+        self.split_events_input = QtWidgets.QCheckBox("Split at Events")
+        self.split_events_input.setToolTip(
+            "Load a continuous recording as one sweep per threshold crossing of the band-passed signal")
         
         browse.clicked.connect(self.on_browse)
         load.clicked.connect(self.on_load)
@@ -65,6 +69,7 @@ class LoadFileLayout(QtWidgets.QHBoxLayout):
         self.setContentsMargins(0,0,0,0)
         self.addWidget(label)
         self.addWidget(self.load_file_input)
+        self.addWidget(self.split_events_input)
         self.addLayout(buttons)
         
     def on_browse(self, event):
@@ -129,31 +134,129 @@ class SaveFileLayout(QtWidgets.QHBoxLayout):
     def value(self):
         return self.save_file_input.text()
 
+class WatchFolderLayout(QtWidgets.QHBoxLayout):
+    watch_toggled_event = QtCore.pyqtSignal(bool)
 
-class GraphWidgetWrapper(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
+
+        label = QtWidgets.QLabel("Watch Acquisition Folder")
+        label.setAlignment(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        self.watch_folder_input = QtWidgets.QLineEdit()
+        self.status_label = QtWidgets.QLabel("")
+        buttons = QtWidgets.QHBoxLayout()
+        browse = QtWidgets.QPushButton("Browse")
+        browse.setFixedWidth(100)
+        self.watch_button = QtWidgets.QPushButton("Watch")
+        self.watch_button.setCheckable(True)
+        self.watch_button.setFixedWidth(100)
+
+        browse.clicked.connect(self.on_browse)
+        self.watch_button.toggled.connect(self.on_toggle)
+
+        buttons.setSpacing(0)
+        label.setContentsMargins(0,0,10,0)
+        self.status_label.setContentsMargins(10,0,10,0)
+        buttons.setContentsMargins(0,0,0,0)
+        buttons.addWidget(browse,0)
+        buttons.addWidget(self.watch_button,0)
+
+        self.setContentsMargins(0,0,0,0)
+        self.setSpacing(0)
+        self.addWidget(label)
+        self.addWidget(self.watch_folder_input)
+        self.addWidget(self.status_label)
+        self.addLayout(buttons)
+
+    def on_browse(self, event):
+        dialog = QtWidgets.QFileDialog()
+        filepath = dialog.getExistingDirectory(None, "Acquisition directory")
+        if filepath:
+            self.watch_folder_input.setText(filepath)
+
+    def on_toggle(self, checked):
+        self.watch_button.setText("Stop" if checked else "Watch")
+        self.watch_folder_input.setEnabled(not checked)
+        self.watch_toggled_event.emit(checked)
+
+    @property
+    def value(self):
+        return self.watch_folder_input.text()
+
+
+class GraphWidgetWrapper(QtWidgets.QWidget):
+    def __init__(self, renderer='matplotlib'):
+        super().__init__()
         self.setContentsMargins(0,0,0,0)
-        self.graph_widget = GraphWidget()
-
-        # Override the default tool item
-        NavigationToolbar2QT.toolitems = (
-            ('Home', 'Reset original view', 'home', 'home'),
-            ('Back', 'Back to previous view', 'back', 'back'),
-            ('Forward', 'Forward to next view', 'forward', 'forward'),
-            ('Zoom', 'Zoom to rectangle\nx/y fixes axis', 'zoom_to_rect', 'zoom'),
-            ('Pan',
-                'Left button pans, Right button zooms\n'
-                'x/y fixes axis, CTRL fixes aspect',
-                'move', 'pan'),
-        )
-        self.toolbar = NavigationToolbar2QT(self.graph_widget, self)
+        self.graph_widget = RENDERERS[renderer]()
+
+        if isinstance(self.graph_widget, FigureCanvasQTAgg):
+            # Override the default tool item
+            NavigationToolbar2QT.toolitems = (
+                ('Home', 'Reset original view', 'home', 'home'),
+                ('Back', 'Back to previous view', 'back', 'back'),
+                ('Forward', 'Forward to next view', 'forward', 'forward'),
+                ('Zoom', 'Zoom to rectangle\nx/y fixes axis', 'zoom_to_rect', 'zoom'),
+                ('Pan',
+                    'Left button pans, Right button zooms\n'
+                    'x/y fixes axis, CTRL fixes aspect',
+                    'move', 'pan'),
+            )
+            self.toolbar = NavigationToolbar2QT(self.graph_widget, self)
+        else:
+            self.toolbar = QtWidgets.QToolBar()
+            self.toolbar.addAction("Home", self.graph_widget.home)
+
+        self.channel_input = QtWidgets.QComboBox()
+        self.channel_input.addItem("Channel 0 (pA)", "pA")
+        self.channel_input.currentIndexChanged.connect(
+            lambda index: self.graph_widget.set_channel(max(index, 0), self.channel_input.currentData()))
+        self.toolbar.addWidget(self.channel_input)
+
+        # Publication figures are always rendered through matplotlib
+        self.toolbar.addAction("Export", self.on_export)
         self.toolbar.setFixedHeight(20)
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self.toolbar)
         layout.addWidget(self.graph_widget)
         self.setLayout(layout)
 
+    def set_channels(self, names, units):
+        self.channel_input.blockSignals(True)
+        self.channel_input.clear()
+        for name, unit in zip(names, units):
+            self.channel_input.addItem(name, unit)
+        self.channel_input.blockSignals(False)
+        self.graph_widget.set_channel(0, units[0])
+
+    def on_export(self):
+        dialog = QtWidgets.QFileDialog()
+        filepath, _ = dialog.getSaveFileName(None, "Export figure", filter="Images (*.png *.pdf *.svg)")
+        if filepath:
+            self.graph_widget.export_figure(filepath)
+
+
+def export_sweep_figure(filepath, time, data, smoothed, trigger, limits, units="pA", width=6, height=2, dpi=300):
+    """Render a sweep with matplotlib and save it to `filepath`
+
+    Used by renderers that do not draw through matplotlib themselves.
+    """
+    fig = Figure(figsize=(width, height), dpi=dpi, tight_layout=True)
+    axes = fig.add_subplot(111)
+    axes.set_xlabel("ms")
+    axes.set_ylabel(units)
+    if data is not None:
+        axes.plot(time, data, linewidth=1.0, label="Raw Signal")
+        if smoothed is not None:
+            axes.plot(time, smoothed, linewidth=1.0, label="Bandpass Signal")
+    if trigger is not None:
+        axes.plot([trigger['xmin'], trigger['xmax']], [trigger['y'], trigger['y']],
+            linewidth=1.5, color='red', linestyle='dashed', label="Bandpass Trigger")
+    axes.set_xlim([limits['xmin'], limits['xmax']])
+    axes.set_ylim([limits['ymin'], limits['ymax']])
+    axes.legend(loc='upper right')
+    axes.grid()
+    fig.savefig(filepath)
 
 class GraphWidget(FigureCanvasQTAgg):
     limits_updated = QtCore.pyqtSignal(dict)
@@ -174,12 +277,23 @@ class GraphWidget(FigureCanvasQTAgg):
         self.lowband = None
         self.highband = None
         self.sweep = None
+        self.channel = 0
+        self.data = None
 
         self.settings_widget: SettingsWidget = None
 
+    def set_channel(self, channel, units):
+        self.channel = channel
+        self.axes.set_ylabel(units)
+        if self.sweep is not None:
+            self.plot_sweep(self.sweep)
+        else:
+            self.fig.canvas.draw()
+
     def plot_sweep(self, sweep):
         self.sweep = sweep
-        self.line.set_data(sweep.time,sweep.data)
+        self.data = sweep.channel_data(self.channel)
+        self.line.set_data(sweep.time,self.data)
 
         if self.settings_widget is not None:
             band_information = self.settings_widget.get_band_information()
@@ -188,7 +302,7 @@ class GraphWidget(FigureCanvasQTAgg):
 
             highband = band_information['highband']
             highband = 0 if highband is None else highband
-            y = pass_filter(self.sweep.data, lowband, highband, sample_rate=self.sweep.sample_rate)
+            y = pass_filter(self.data, lowband, highband, sample_rate=self.sweep.sample_rate)
             self.smoothed_line.set_data(self.sweep.time, y)
 
         self.fig.canvas.draw()
@@ -207,6 +321,13 @@ class GraphWidget(FigureCanvasQTAgg):
         self.fig.canvas.draw()
         self.limits_updated.emit(plot_limits)
 
+    def set_home_limits(self, plot_limits):
+        self.on_plot_limits_changed(plot_limits)
+        # Restart the toolbar history so Home returns to these limits
+        if self.toolbar is not None:
+            self.toolbar.update()
+            self.toolbar.push_current()
+
     def update_trigger(self, trigger_limits):
         xmin = trigger_limits['xmin']
         xmax = trigger_limits['xmax']
@@ -226,11 +347,300 @@ class GraphWidget(FigureCanvasQTAgg):
             # likely if sweep is not defined
 
         if self.sweep is not None:
-            y = pass_filter(self.sweep.data, lowband, highband, sample_rate=self.sweep.sample_rate)
+            y = pass_filter(self.data, lowband, highband, sample_rate=self.sweep.sample_rate)
             self.smoothed_line.set_data(self.sweep.time, y)
 
         self.fig.canvas.draw()
 
+    def export_figure(self, filepath):
+        self.fig.savefig(filepath, dpi=300)
+
+
+def nice_ticks(vmin, vmax, count=6):
+    """Evenly spaced tick values on a 1/2/5 grid covering [vmin, vmax]
+    """
+    span = vmax - vmin
+    if not np.isfinite(span) or span <= 0:
+        return np.array([vmin])
+
+    raw_step = span / count
+    magnitude = 10 ** np.floor(np.log10(raw_step))
+    step = magnitude * min((1, 2, 5, 10), key=lambda x: abs(x * magnitude - raw_step))
+    return np.arange(np.ceil(vmin / step), np.floor(vmax / step) + 1) * step
+
+
+def decimate_trace(y, sample_rate, xmin, xmax, columns):
+    """Reduce a uniformly sampled trace to a min/max envelope with at most
+    two points per pixel column, keeping only the visible samples.
+
+    The visible samples are found from the sample rate, so no time array of
+    the whole trace is needed. Returns the (time, value) points.
+    """
+    first, last = np.clip(np.ceil(np.array([xmin, xmax]) * sample_rate), 0, len(y)).astype(int)
+    start = max(first - 1, 0)
+    stop = min(last + 1, len(y))
+    y = y[start:stop]
+    if len(y) <= 2 * columns:
+        return (start + np.arange(len(y))) / sample_rate, y
+
+    edges = np.linspace(0, len(y), columns + 1).astype(int)[:-1]
+    ymin = np.minimum.reduceat(y, edges)
+    ymax = np.maximum.reduceat(y, edges)
+    return np.repeat((start + edges) / sample_rate, 2), np.column_stack([ymin, ymax]).ravel()
+
+
+class QPainterGraphWidget(QtWidgets.QWidget):
+    """Native trace view drawn with QPainter
+
+    Implements the same slots as `GraphWidget` but skips the Agg rasterizer,
+    decimating each trace to the visible pixel columns before drawing.
+    Left button pans, right button or the scroll wheel zooms, double click
+    resets the view.
+    """
+    limits_updated = QtCore.pyqtSignal(dict)
+
+    MARGIN_LEFT = 55
+    MARGIN_RIGHT = 10
+    MARGIN_TOP = 10
+    MARGIN_BOTTOM = 35
+
+    RAW_PEN = QtGui.QPen(QtGui.QColor('#1f77b4'), 1.0)
+    SMOOTHED_PEN = QtGui.QPen(QtGui.QColor('#ff7f0e'), 1.0)
+    TRIGGER_PEN = QtGui.QPen(QtGui.QColor('red'), 1.5, Qt.PenStyle.DashLine)
+    GRID_PEN = QtGui.QPen(QtGui.QColor('#b0b0b0'), 0.8)
+
+    def __init__(self, parent=None, width=6, height=2, dpi=100):
+        super().__init__(parent)
+        self.setContentsMargins(0,0,0,0)
+        self.setMinimumSize(width * dpi // 2, height * dpi)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Policy.Expanding, QtWidgets.QSizePolicy.Policy.Expanding)
+
+        self.lowband = None
+        self.highband = None
+        self.sweep = None
+        self.channel = 0
+        self.units = "pA"
+        self.data = None
+        self.smoothed = None
+        self.trigger = None
+
+        self.xlim = [0.0, 1.0]
+        self.ylim = [0.0, 1.0]
+        self.home_limits = None
+        self._drag_origin = None
+
+        self.settings_widget: SettingsWidget = None
+
+    def set_channel(self, channel, units):
+        self.channel = channel
+        self.units = units
+        if self.sweep is not None:
+            self.plot_sweep(self.sweep)
+        else:
+            self.update()
+
+    def plot_sweep(self, sweep):
+        self.sweep = sweep
+        self.data = sweep.channel_data(self.channel)
+        self.smoothed = None
+
+        if self.settings_widget is not None:
+            band_information = self.settings_widget.get_band_information()
+            lowband = band_information['lowband']
+            lowband = 0 if lowband is None else lowband
+
+            highband = band_information['highband']
+            highband = 0 if highband is None else highband
+            self.smoothed = pass_filter(self.data, lowband, highband, sample_rate=self.sweep.sample_rate)
+
+        self.update()
+
+    def get_limits(self):
+        return dict(xmin=self.xlim[0], xmax=self.xlim[1], ymin=self.ylim[0], ymax=self.ylim[1])
+
+    def on_plot_limits_changed(self, plot_limits):
+        xmin = self.xlim[0] if plot_limits['xmin'] is None else plot_limits['xmin']
+        xmax = self.xlim[1] if plot_limits['xmax'] is None else plot_limits['xmax']
+        ymin = self.ylim[0] if plot_limits['ymin'] is None else plot_limits['ymin']
+        ymax = self.ylim[1] if plot_limits['ymax'] is None else plot_limits['ymax']
+
+        self.xlim = [xmin, xmax]
+        self.ylim = [ymin, ymax]
+        self.update()
+        self.limits_updated.emit(plot_limits)
+
+    def set_home_limits(self, plot_limits):
+        self.on_plot_limits_changed(plot_limits)
+        self.home_limits = self.get_limits()
+
+    def home(self):
+        if self.home_limits is not None:
+            self.on_plot_limits_changed(dict(self.home_limits))
+
+    def update_trigger(self, trigger_limits):
+        self.trigger = trigger_limits
+        self.update()
+
+    def update_bandwidth(self, bandlimits):
+        try:
+            lowband = bandlimits['lowband']
+            highband = bandlimits['highband']
+        except KeyError as e:
+            print(f"Band limits are missing {e}")
+            return
+
+        if self.sweep is not None:
+            self.smoothed = pass_filter(self.data, lowband, highband, sample_rate=self.sweep.sample_rate)
+
+        self.update()
+
+    def export_figure(self, filepath):
+        time = None if self.sweep is None else self.sweep.time
+        export_sweep_figure(filepath, time, self.data, self.smoothed, self.trigger, self.get_limits(), self.units)
+
+    def plot_rect(self):
+        return QtCore.QRectF(self.rect()).adjusted(
+            self.MARGIN_LEFT, self.MARGIN_TOP, -self.MARGIN_RIGHT, -self.MARGIN_BOTTOM)
+
+    def to_pixels(self, rect, x, y):
+        xmin, xmax = self.xlim
+        ymin, ymax = self.ylim
+        px = rect.left() + (x - xmin) * (rect.width() / (xmax - xmin))
+        py = rect.bottom() - (y - ymin) * (rect.height() / (ymax - ymin))
+        return px, py
+
+    def to_data(self, rect, px, py):
+        xmin, xmax = self.xlim
+        ymin, ymax = self.ylim
+        x = xmin + (px - rect.left()) * (xmax - xmin) / rect.width()
+        y = ymin + (rect.bottom() - py) * (ymax - ymin) / rect.height()
+        return x, y
+
+    def make_polygon(self, rect, y, sample_rate):
+        x, y = decimate_trace(y, sample_rate, self.xlim[0], self.xlim[1], max(int(rect.width()), 1))
+        polygon = QtGui.QPolygonF()
+        polygon.resize(len(x))
+        if len(x) == 0:
+            return polygon
+
+        # Fill the QPointF storage in place from numpy
+        pointer = polygon.data()
+        pointer.setsize(len(x) * 2 * np.dtype(np.float64).itemsize)
+        buffer = np.frombuffer(pointer, dtype=np.float64).reshape(-1, 2)
+        buffer[:,0], buffer[:,1] = self.to_pixels(rect, x, y)
+        return polygon
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), Qt.GlobalColor.white)
+        rect = self.plot_rect()
+        if rect.width() <= 0 or rect.height() <= 0 or self.xlim[0] == self.xlim[1] or self.ylim[0] == self.ylim[1]:
+            return
+
+        # Grid and tick labels
+        metrics = painter.fontMetrics()
+        painter.setPen(self.GRID_PEN)
+        xticks = nice_ticks(*self.xlim)
+        yticks = nice_ticks(*self.ylim)
+        xpixels, _ = self.to_pixels(rect, xticks, 0)
+        _, ypixels = self.to_pixels(rect, 0, yticks)
+        for px in xpixels:
+            painter.drawLine(QtCore.QLineF(px, rect.top(), px, rect.bottom()))
+        for py in ypixels:
+            painter.drawLine(QtCore.QLineF(rect.left(), py, rect.right(), py))
+
+        painter.setPen(Qt.GlobalColor.black)
+        for value, px in zip(xticks, xpixels):
+            text = f"{value + 0:g}"
+            painter.drawText(QtCore.QPointF(px - metrics.horizontalAdvance(text) / 2, rect.bottom() + metrics.height()), text)
+        for value, py in zip(yticks, ypixels):
+            text = f"{value + 0:g}"
+            painter.drawText(QtCore.QPointF(rect.left() - metrics.horizontalAdvance(text) - 4, py + metrics.ascent() / 2), text)
+
+        painter.drawText(QtCore.QPointF(rect.center().x() - metrics.horizontalAdvance("ms") / 2, self.height() - 4), "ms")
+        painter.save()
+        painter.translate(metrics.height(), rect.center().y())
+        painter.rotate(-90)
+        painter.drawText(QtCore.QPointF(-metrics.horizontalAdvance(self.units) / 2, 0), self.units)
+        painter.restore()
+        painter.drawRect(rect)
+
+        # Traces
+        painter.setClipRect(rect)
+        if self.sweep is not None:
+            painter.setPen(self.RAW_PEN)
+            painter.drawPolyline(self.make_polygon(rect, self.data, self.sweep.sample_rate))
+            if self.smoothed is not None:
+                painter.setPen(self.SMOOTHED_PEN)
+                painter.drawPolyline(self.make_polygon(rect, self.smoothed, self.sweep.sample_rate))
+
+        if self.trigger is not None and None not in self.trigger.values():
+            painter.setPen(self.TRIGGER_PEN)
+            (x0, x1), (y0, y1) = self.to_pixels(rect, np.array([self.trigger['xmin'], self.trigger['xmax']]), np.array([self.trigger['y']] * 2))
+            painter.drawLine(QtCore.QLineF(x0, y0, x1, y1))
+        painter.setClipping(False)
+
+        # Legend
+        entries = [("Raw Signal", self.RAW_PEN), ("Bandpass Signal", self.SMOOTHED_PEN), ("Bandpass Trigger", self.TRIGGER_PEN)]
+        legend_width = 30 + max(metrics.horizontalAdvance(label) for label, _ in entries)
+        top = rect.top() + 6
+        left = rect.right() - legend_width - 6
+        painter.fillRect(QtCore.QRectF(left, top, legend_width, len(entries) * metrics.height() + 4), QtGui.QColor(255, 255, 255, 200))
+        for i, (label, pen) in enumerate(entries):
+            y = top + 2 + (i + 0.5) * metrics.height()
+            painter.setPen(pen)
+            painter.drawLine(QtCore.QLineF(left + 4, y, left + 22, y))
+            painter.setPen(Qt.GlobalColor.black)
+            painter.drawText(QtCore.QPointF(left + 26, y + metrics.ascent() / 2 - 1), label)
+
+    def mousePressEvent(self, event):
+        self._drag_origin = (event.position(), list(self.xlim), list(self.ylim))
+
+    def mouseMoveEvent(self, event):
+        if self._drag_origin is None:
+            return
+
+        origin, xlim, ylim = self._drag_origin
+        rect = self.plot_rect()
+        dx = (event.position().x() - origin.x()) / rect.width()
+        dy = (event.position().y() - origin.y()) / rect.height()
+        xspan = xlim[1] - xlim[0]
+        yspan = ylim[1] - ylim[0]
+        if event.buttons() & Qt.MouseButton.LeftButton:
+            self.xlim = [xlim[0] - dx * xspan, xlim[1] - dx * xspan]
+            self.ylim = [ylim[0] + dy * yspan, ylim[1] + dy * yspan]
+        elif event.buttons() & Qt.MouseButton.RightButton:
+            xscale = 10 ** -dx
+            yscale = 10 ** dy
+            xcenter = (xlim[0] + xlim[1]) / 2
+            ycenter = (ylim[0] + ylim[1]) / 2
+            self.xlim = [xcenter - xspan * xscale / 2, xcenter + xspan * xscale / 2]
+            self.ylim = [ycenter - yspan * yscale / 2, ycenter + yspan * yscale / 2]
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self._drag_origin is not None:
+            self._drag_origin = None
+            self.limits_updated.emit(self.get_limits())
+
+    def mouseDoubleClickEvent(self, event):
+        self.home()
+
+    def wheelEvent(self, event):
+        rect = self.plot_rect()
+        x, y = self.to_data(rect, event.position().x(), event.position().y())
+        scale = 0.8 if event.angleDelta().y() > 0 else 1.25
+        self.xlim = [x + (self.xlim[0] - x) * scale, x + (self.xlim[1] - x) * scale]
+        self.ylim = [y + (self.ylim[0] - y) * scale, y + (self.ylim[1] - y) * scale]
+        self.update()
+        self.limits_updated.emit(self.get_limits())
+
+
+RENDERERS = {
+    'matplotlib': GraphWidget,
+    'qpainter': QPainterGraphWidget,
+}
+
 class SettingsWidget(QtWidgets.QTabWidget):
     plot_limits_changed_event = QtCore.pyqtSignal(dict)
     show_smoothed_plot = QtCore.pyqtSignal(bool)
@@ -238,17 +648,26 @@ class SettingsWidget(QtWidgets.QTabWidget):
     apply = QtCore.pyqtSignal()
     trigger_changed = QtCore.pyqtSignal(dict)
     band_changed = QtCore.pyqtSignal(dict)
+    template_requested = QtCore.pyqtSignal()
+    order_changed = QtCore.pyqtSignal(bool)
+    # Score threshold, and whether sweeps above it move to signal (else below it to noise)
+    move_by_score_requested = QtCore.pyqtSignal(float, bool)
+    undo_requested = QtCore.pyqtSignal()
+    redo_requested = QtCore.pyqtSignal()
 
     def __init__(self):
         super().__init__()
         self.setFixedHeight(180)
         self.plotting_tab = QtWidgets.QWidget()
         self.bandpass_tab = QtWidgets.QWidget()
+        self.detection_tab = QtWidgets.QWidget()
 
         self.addTab(self.plotting_tab, "Plotting")
         # self.addTab(self.bandpass_tab, "Trigger")
+        self.addTab(self.detection_tab, "Detection")
 
         self.setup_plotting_tab()
+        self.setup_detection_tab()
         # self.setup_bandpass_tab()
         self.setStyleSheet('''
         QTabWidget::tab-bar {
@@ -341,6 +760,124 @@ class SettingsWidget(QtWidgets.QTabWidget):
         
         self.on_plot_limits_changed()
 
+    def setup_detection_tab(self):
+        layout = QtWidgets.QHBoxLayout()
+        layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignLeft)
+
+        self.detector_input = QtWidgets.QComboBox()
+        for name, detector in DETECTORS.items():
+            self.detector_input.addItem(detector.label, name)
+
+        self.dvdt_threshold_input = QtWidgets.QLineEdit()
+        self.dvdt_threshold_input.setValidator(QDoubleValidator())
+        self.template_threshold_input = QtWidgets.QLineEdit()
+        self.template_threshold_input.setValidator(QDoubleValidator(-1.0, 1.0, 3))
+        self.template_label = QtWidgets.QLabel("None")
+        self.template_button = QtWidgets.QPushButton("Use Current Sweep")
+        self.n_clusters_input = QtWidgets.QLineEdit()
+        self.n_clusters_input.setValidator(QIntValidator(2, 20))
+        self.order_input = QtWidgets.QComboBox()
+        self.order_input.addItem("Sweep number", False)
+        self.order_input.addItem("Least confident first", True)
+
+        column = QtWidgets.QFormLayout()
+        column.addRow("Detector", self.detector_input)
+        column.addRow("dV/dt Trigger (pA/ms)", self.dvdt_threshold_input)
+        column.addRow("Clusters", self.n_clusters_input)
+        column.addRow("List Order", self.order_input)
+        layout.addLayout(column)
+
+        self.channels_input = QtWidgets.QLineEdit()
+        self.channels_input.setValidator(QtGui.QRegularExpressionValidator(QtCore.QRegularExpression(r"\d+(\s*,\s*\d+)*")))
+        self.channel_rule_input = QtWidgets.QComboBox()
+        self.channel_rule_input.addItem("Any channel", 'any')
+        self.channel_rule_input.addItem("All channels", 'all')
+
+        column = QtWidgets.QFormLayout()
+        column.addRow("Detection Channels", self.channels_input)
+        column.addRow("Channel Rule", self.channel_rule_input)
+        layout.addLayout(column)
+
+        self.event_before_input = QtWidgets.QLineEdit()
+        self.event_before_input.setValidator(QDoubleValidator(0.0, 1e3, 4))
+        self.event_after_input = QtWidgets.QLineEdit()
+        self.event_after_input.setValidator(QDoubleValidator(0.0, 1e3, 4))
+
+        column = QtWidgets.QFormLayout()
+        column.addRow("Event Window Before (s)", self.event_before_input)
+        column.addRow("Event Window After (s)", self.event_after_input)
+        layout.addLayout(column)
+
+        column = QtWidgets.QFormLayout()
+        column.addRow("Template Min. Correlation", self.template_threshold_input)
+        column.addRow("Template Sweep", self.template_label)
+        column.addRow("", self.template_button)
+        layout.addLayout(column)
+
+        self.move_score_input = QtWidgets.QLineEdit()
+        self.move_score_input.setValidator(QDoubleValidator())
+        move_above_button = QtWidgets.QPushButton("Move All Above to Signal")
+        move_below_button = QtWidgets.QPushButton("Move All Below to Noise")
+        undo_button = QtWidgets.QPushButton("Undo")
+        undo_button.setToolTip("Undo the last move (Ctrl+Z)")
+        redo_button = QtWidgets.QPushButton("Redo")
+        redo_button.setToolTip("Redo the last undone move (Ctrl+Shift+Z)")
+        history = QtWidgets.QHBoxLayout()
+        history.addWidget(undo_button)
+        history.addWidget(redo_button)
+
+        column = QtWidgets.QFormLayout()
+        column.addRow("Score", self.move_score_input)
+        column.addRow("", move_above_button)
+        column.addRow("", move_below_button)
+        column.addRow("", history)
+        layout.addLayout(column)
+
+        layout.addStretch()
+        self.detection_tab.setLayout(layout)
+
+        move_above_button.clicked.connect(lambda: self.on_move_by_score(True))
+        move_below_button.clicked.connect(lambda: self.on_move_by_score(False))
+        undo_button.clicked.connect(lambda: self.undo_requested.emit())
+        redo_button.clicked.connect(lambda: self.redo_requested.emit())
+
+        self.dvdt_threshold_input.setText("5.0")
+        self.template_threshold_input.setText("0.8")
+        self.n_clusters_input.setText("2")
+        self.channels_input.setText("0")
+        self.event_before_input.setText("0.01")
+        self.event_after_input.setText("0.04")
+        self.template_button.clicked.connect(lambda: self.template_requested.emit())
+        self.detector_input.currentIndexChanged.connect(self.on_detector_changed)
+        self.order_input.currentIndexChanged.connect(lambda: self.order_changed.emit(self.order_input.currentData()))
+
+    def on_move_by_score(self, above):
+        if self.move_score_input.text():
+            self.move_by_score_requested.emit(float(self.move_score_input.text()), above)
+
+    def on_detector_changed(self, event=None):
+        # Clustering leaves an uncertain middle, review it first
+        if self.detector_input.currentData() == 'cluster':
+            self.order_input.setCurrentIndex(self.order_input.findData(True))
+
+    def get_detector_information(self):
+        float_or_none = lambda x: None if isinstance(x,str) and len(x)==0 else float(x)
+        return {
+            'detector': self.detector_input.currentData(),
+            'dvdt_threshold': float_or_none(self.dvdt_threshold_input.text()),
+            'template_threshold': float_or_none(self.template_threshold_input.text()),
+            'n_clusters': float_or_none(self.n_clusters_input.text()),
+            'channels': [int(x) for x in self.channels_input.text().split(',') if x.strip()] or None,
+            'channel_rule': self.channel_rule_input.currentData(),
+        }
+
+    def get_event_information(self):
+        float_or_none = lambda x: None if isinstance(x,str) and len(x)==0 else float(x)
+        return {
+            'before': float_or_none(self.event_before_input.text()),
+            'after': float_or_none(self.event_after_input.text()),
+        }
+
     def get_band_information(self):
         lowband = self.lowband_input.text()
         highband = self.highband_input.text()
@@ -401,7 +938,7 @@ class SettingsWidget(QtWidgets.QTabWidget):
 class SignalListWidgetItem(QtWidgets.QListWidgetItem):
     def __init__(self, sweep):
         self.sweep = sweep
-        self.label = f"Sweep {self.sweep.number}"
+        self.label = self.sweep.label
         super().__init__(self.label)
 
     def __lt__(self, other):
@@ -429,6 +966,8 @@ class ListWidget(QtWidgets.QListWidget):
 class SignalListView(QtWidgets.QHBoxLayout):
     sweep_changed_event = QtCore.pyqtSignal(Sweep)
     keyPressed = QtCore.pyqtSignal(QtCore.QEvent)
+    # Session indices of the selected sweeps and the group they should move to
+    move_requested = QtCore.pyqtSignal(object, SignalGroup)
 
     def __init__(self):
         super().__init__()
@@ -453,6 +992,15 @@ class SignalListView(QtWidgets.QHBoxLayout):
 
         self.signal_list.setFixedWidth(100)
         self.noise_list.setFixedWidth(100)
+        self.signal_list.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.noise_list.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.signal_list.setUniformItemSizes(True)
+        self.noise_list.setUniformItemSizes(True)
+        self.lists = {SignalGroup.ACTIVITY: self.signal_list, SignalGroup.NOISE: self.noise_list}
+
+        # Item of each session index, and the sorted list positions (ranks) in each list
+        self.items = {}
+        self.ranks = {self.signal_list: np.array([], dtype=int), self.noise_list: np.array([], dtype=int)}
 
         self.addLayout(signal_vlayout)
         self.addLayout(noise_vlayout)
@@ -464,16 +1012,100 @@ class SignalListView(QtWidgets.QHBoxLayout):
         self.signal_list.focused.connect(self.on_signal_item_selection_changed)
         self.noise_list.focused.connect(self.on_noise_item_selection_changed)
 
-    def update_sweeps(self, sweeps):
+    def update_sweeps(self, sweeps, indices=None):
+        """Rebuild both lists from `sweeps` in list order, `indices` being their positions in the session
+        """
+        indices = range(len(sweeps)) if indices is None else indices
         self.noise_list.clear()
         self.signal_list.clear()
-        # print("update sweeps")
-        for sweep in sweeps:
+        self.items = {}
+        ranks = {self.signal_list: [], self.noise_list: []}
+        for rank, (index, sweep) in enumerate(zip(indices, sweeps)):
             sweep_item = SignalListWidgetItem(sweep)
-            if sweep.group == SignalGroup.ACTIVITY:
-                self.signal_list.addItem(sweep_item)
-            elif sweep.group == SignalGroup.NOISE:
-                self.noise_list.addItem(sweep_item)
+            sweep_item.index = int(index)
+            sweep_item.rank = rank
+            self.items[int(index)] = sweep_item
+            widget = self.lists.get(sweep.group)
+            if widget is not None:
+                widget.addItem(sweep_item)
+                ranks[widget].append(rank)
+        self.ranks = {widget: np.array(r, dtype=int) for widget, r in ranks.items()}
+
+    def append_items(self, sweeps, indices):
+        """Add `sweeps`, at session `indices`, to the end of the lists without rebuilding them
+        """
+        added = {self.signal_list: [], self.noise_list: []}
+        for rank, (index, sweep) in enumerate(zip(indices, sweeps), len(self.items)):
+            sweep_item = SignalListWidgetItem(sweep)
+            sweep_item.index = int(index)
+            sweep_item.rank = rank
+            self.items[int(index)] = sweep_item
+            widget = self.lists.get(sweep.group)
+            if widget is not None:
+                widget.addItem(sweep_item)
+                added[widget].append(rank)
+        for widget, ranks in added.items():
+            self.ranks[widget] = np.concatenate([self.ranks[widget], np.array(ranks, dtype=int)])
+
+    def move_items(self, indices):
+        """Move the items of the sweeps at `indices` into the list of their current group
+
+        Only the moved items are taken out and inserted, at the rows that keep the
+        list order. The first moved item becomes current in its new list, and a
+        list that lost items keeps its current row.
+        """
+        leaving = {self.signal_list: [], self.noise_list: []}
+        for index in indices:
+            item = self.items.get(int(index))
+            if item is not None and item.listWidget() is not self.lists[item.sweep.group]:
+                leaving[item.listWidget()].append(item)
+
+        if not any(leaving.values()):
+            return
+
+        # A selection holds persistent indices that every removal and insertion updates
+        for widget in self.lists.values():
+            widget.setUpdatesEnabled(False)
+            widget.blockSignals(True)
+            widget.clearSelection()
+
+        moved = {self.signal_list: [], self.noise_list: []}
+        current_rows = {}
+        for widget, items in leaving.items():
+            if not items:
+                continue
+            rows = np.searchsorted(self.ranks[widget], [item.rank for item in items])
+            current_rows[widget] = rows.min()
+            for row in np.sort(rows)[::-1]:
+                widget.takeItem(int(row))
+            self.ranks[widget] = np.delete(self.ranks[widget], rows)
+            for item in items:
+                moved[self.lists[item.sweep.group]].append(item)
+
+        for widget, items in moved.items():
+            if not items:
+                continue
+            items.sort(key=lambda item: item.rank)
+            new_ranks = np.array([item.rank for item in items], dtype=int)
+            self.ranks[widget] = np.sort(np.concatenate([self.ranks[widget], new_ranks]))
+            for row, item in zip(np.searchsorted(self.ranks[widget], new_ranks), items):
+                widget.insertItem(int(row), item)
+
+            # Selecting every moved item would leave a fragmented selection that
+            # slows down later moves, so only the first becomes current
+            widget.setCurrentItem(items[0])
+            widget.scrollToItem(items[0])
+
+        for widget in self.lists.values():
+            widget.blockSignals(False)
+            widget.setUpdatesEnabled(True)
+
+        for widget, row in current_rows.items():
+            if widget.count() > 0:
+                widget.setCurrentRow(int(min(row, widget.count() - 1)))
+
+    def selected_indices(self, widget):
+        return np.array(sorted(item.index for item in widget.selectedItems()), dtype=int)
 
     def on_noise_item_selection_changed(self):
         if not self.noise_list.hasFocus():
@@ -497,71 +1129,31 @@ class SignalListView(QtWidgets.QHBoxLayout):
             self.sweep_changed_event.emit(sweep)
 
     def on_key_pressed_from_signal_list(self, event):
-        try:
-            count = self.signal_list.count()
-            row = self.signal_list.currentRow()
-            sweep = self.signal_list.currentItem().sweep
-
-            if event.key() == Qt.Key.Key_Right:
-                # print("Move to noise")
-                sweep.group = SignalGroup.NOISE
-
-                # In the other list, set the row to active
-                for i in range(self.noise_list.count()):
-                    item = self.noise_list.item(i)
-                    if item.sweep == sweep:
-                        self.noise_list.scrollToItem(item)
-                        self.noise_list.setCurrentItem(item)
-
-                # Set the next row to active
-                if row + 1 < count:
-                    self.signal_list.setCurrentRow(row)
-                elif count > 0:
-                    self.signal_list.setCurrentRow(row-1)
-
-        except AttributeError as e:
-            pass
+        # Move every selected sweep to noise
+        if event.key() == Qt.Key.Key_Right:
+            self.move_requested.emit(self.selected_indices(self.signal_list), SignalGroup.NOISE)
 
     def on_key_pressed_from_noise_list(self, event):
-        try:
-            count = self.noise_list.count()
-            row = self.noise_list.currentRow()
-            sweep = self.noise_list.currentItem().sweep
-
-            if event.key() == Qt.Key.Key_Left:
-                # print("move to signal")
-                sweep.group = SignalGroup.ACTIVITY
-
-                # In the other list, set the row to active
-                for i in range(self.signal_list.count()):
-                    item = self.signal_list.item(i)
-                    if item.sweep == sweep:
-                        self.signal_list.scrollToItem(item)
-                        self.signal_list.setCurrentItem(item)
-
-                # Set the next row to active
-                if row + 1 < count:
-                    self.noise_list.setCurrentRow(row)
-                elif count > 0:
-                    self.noise_list.setCurrentRow(row-1)
-
-        except AttributeError as e:
-            pass
+        # Move every selected sweep to signal
+        if event.key() == Qt.Key.Key_Left:
+            self.move_requested.emit(self.selected_indices(self.noise_list), SignalGroup.ACTIVITY)
 
 class View(QtWidgets.QWidget):
-    def __init__(self):
+    def __init__(self, renderer='matplotlib', memory_budget=None, storage='float32'):
         super().__init__()
-        self.model = Model()
+        self.model = Model(memory_budget, storage)
 
         layout = QtWidgets.QVBoxLayout()
         layout.setAlignment(Qt.AlignmentFlag.AlignTop)
 
         self.load_file_layout = LoadFileLayout()
         layout.addLayout(self.load_file_layout)
+        self.watch_folder_layout = WatchFolderLayout()
+        layout.addLayout(self.watch_folder_layout)
         center_layout = QtWidgets.QHBoxLayout()
         center_left_layout = QtWidgets.QVBoxLayout()
 
-        self.graph_widget_wrapper = GraphWidgetWrapper()
+        self.graph_widget_wrapper = GraphWidgetWrapper(renderer)
         self.graph_widget = self.graph_widget_wrapper.graph_widget
         self.settings_widget = SettingsWidget()
 
@@ -576,18 +1168,47 @@ class View(QtWidgets.QWidget):
 
         self.save_file_widget = SaveFileLayout()
         layout.addLayout(self.save_file_widget)
+        self.memory_label = QtWidgets.QLabel("")
+        layout.addWidget(self.memory_label)
         self.setLayout(layout)
 
         self.load_file_layout.load_file_event.connect(self.load)
         self.save_file_widget.save_file_event.connect(self.save)
         self.model.on_sweeps_changed.connect(self.update_sweeps)
+        self.model.on_groups_changed.connect(self.signal_list_view.move_items)
+        self.model.on_sweeps_appended.connect(self.append_sweeps)
+        self.signal_list_view.move_requested.connect(self.model.move_sweeps)
+        self.settings_widget.move_by_score_requested.connect(self.move_by_score)
+        self.settings_widget.undo_requested.connect(self.model.undo)
+        self.settings_widget.redo_requested.connect(self.model.redo)
+        QtGui.QShortcut(QtGui.QKeySequence.StandardKey.Undo, self).activated.connect(self.model.undo)
+        QtGui.QShortcut(QtGui.QKeySequence.StandardKey.Redo, self).activated.connect(self.model.redo)
+        # The platform redo key is Ctrl+Y on some systems; always accept Ctrl+Shift+Z too
+        redo_key = QtGui.QKeySequence("Ctrl+Shift+Z")
+        if redo_key not in QtGui.QKeySequence.keyBindings(QtGui.QKeySequence.StandardKey.Redo):
+            QtGui.QShortcut(redo_key, self).activated.connect(self.model.redo)
+        self.signal_list_view.sweep_changed_event.connect(self.model.show_sweep)
         self.signal_list_view.sweep_changed_event.connect(self.graph_widget.plot_sweep)
         self.settings_widget.plot_limits_changed_event.connect(self.graph_widget.on_plot_limits_changed)
         self.model.on_load_complete.connect(self.reset_plot_limits)
+        self.model.on_load_complete.connect(self.update_channels)
         self.graph_widget.limits_updated.connect(self.settings_widget.update_plot_limits)
         self.settings_widget.trigger_changed.connect(self.graph_widget.update_trigger)
         self.settings_widget.band_changed.connect(self.graph_widget.update_bandwidth)
         self.settings_widget.apply.connect(self.autosort_sweeps)
+        self.settings_widget.template_requested.connect(self.set_template_sweep)
+        self.settings_widget.order_changed.connect(self.set_order_by_confidence)
+        self.watch_folder_layout.watch_toggled_event.connect(self.toggle_watch)
+
+        self.folder_watcher = None
+        self.watch_timer = QtCore.QTimer(self)
+        self.watch_timer.setInterval(WATCH_INTERVAL_MS)
+        self.watch_timer.timeout.connect(self.poll_watch_folder)
+
+        self.memory_timer = QtCore.QTimer(self)
+        self.memory_timer.setInterval(MEMORY_INTERVAL_MS)
+        self.memory_timer.timeout.connect(self.update_memory_label)
+        self.memory_timer.start()
 
         # For communication
         self.graph_widget.settings_widget = self.settings_widget
@@ -605,80 +1226,248 @@ class View(QtWidgets.QWidget):
         layout.addLayout(right_vbox)
         
     def load(self):
+        # A new session replaces the watched one
+        self.watch_folder_layout.watch_button.setChecked(False)
+        if self.load_file_layout.split_events_input.isChecked():
+            self.load_events()
+            return
+
         try:
             self.model.load_file(self.load_file_layout.value)
         except:
             QtWidgets.QMessageBox.about(self,'Error',"Invalid file path")
 
+    def load_events(self):
+        """Load the file as one sweep per event, found with the band and trigger settings
+        """
+        event_information = self.settings_widget.get_event_information()
+        if None in event_information.values():
+            QtWidgets.QMessageBox.about(self,'Error',"Fields cannot be empty: event window")
+            return
+        if not self.apply_settings_to_model():
+            return
+
+        try:
+            self.model.load_events(self.load_file_layout.value, **event_information)
+        except Exception as e:
+            QtWidgets.QMessageBox.about(self,'Error',f"Could not load events: {e}")
+
     def save(self):
         if self.save_file_widget.value is not None:
             self.model.save(self.save_file_widget.value)
 
     def update_sweeps(self):
-        self.signal_list_view.update_sweeps(self.model.sweeps)
+        order = self.model.review_order()
+        self.signal_list_view.update_sweeps([self.model.sweeps[i] for i in order], order)
 
-    def reset_plot_limits(self):
-        data = []
-        for sweep in self.model.sweeps:
-            data.append({
-                'xmin': min(sweep.time),
-                'xmax': max(sweep.time),
-                'ymin': min(sweep.data),
-                'ymax': max(sweep.data),
-            })
+    def append_sweeps(self, indices):
+        # Appended sweeps have no confidence yet, so they come last in either list order
+        self.signal_list_view.append_items([self.model.sweeps[i] for i in indices], indices)
 
-        df = pd.DataFrame(data)
-        xmin, ymin = df[['xmin', 'ymin']].min()
-        xmax, ymax = df[['xmax', 'ymax']].max()
+    def move_by_score(self, threshold, above):
+        if np.isnan(self.model.scores).all():
+            QtWidgets.QMessageBox.about(self,'Error',"Run the detector first to score the sweeps")
+            return
+        self.model.move_by_score(threshold, above, SignalGroup.ACTIVITY if above else SignalGroup.NOISE)
 
-        self.graph_widget.on_plot_limits_changed(dict(xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax))
+    def set_order_by_confidence(self, value):
+        self.model.order_by_confidence = value
+        self.update_sweeps()
 
-    def autosort_sweeps(self):
+    def update_channels(self):
+        self.graph_widget_wrapper.set_channels(self.model.channel_names, self.model.channel_units)
+
+    def reset_plot_limits(self):
+        self.graph_widget.set_home_limits(self.model.data_limits())
+
+    def update_memory_label(self):
+        self.memory_label.setText(format_memory_stats(self.model.memory_stats()))
+
+    def apply_settings_to_model(self):
+        """Copy the trigger and band settings into the model, returns False if any are missing
+        """
         trigger_information = self.settings_widget.get_trigger_information()
         band_information = self.settings_widget.get_band_information()
+        detector_information = self.settings_widget.get_detector_information()
 
         empty_keys = []
-        for key, value in {**trigger_information, **band_information}.items():
+        for key, value in {**trigger_information, **band_information, **detector_information}.items():
             if value is None:
                 empty_keys.append(key)
 
         if len(empty_keys):
             QtWidgets.QMessageBox.about(self,'Error',"Fields cannot be empty: " + ', '.join(empty_keys))
+            return False
+
+        self.model.trigger_xmin = trigger_information['xmin']
+        self.model.trigger_xmax = trigger_information['xmax']
+        self.model.trigger_ysmoothed = trigger_information['y']
+        self.model.highband = band_information['highband']
+        self.model.lowband = band_information['lowband']
+        self.model.detector_name = detector_information['detector']
+        self.model.dvdt_threshold = detector_information['dvdt_threshold']
+        self.model.template_threshold = detector_information['template_threshold']
+        self.model.n_clusters = int(detector_information['n_clusters'])
+
+        channels = detector_information['channels']
+        if max(channels) >= len(self.model.channel_names):
+            QtWidgets.QMessageBox.about(self,'Error',f"This file has {len(self.model.channel_names)} channel(s)")
+            return False
+        self.model.detection_channels = channels
+        self.model.channel_rule = detector_information['channel_rule']
+
+        template = self.model.template_sweep_index
+        if self.model.detector_name == 'template' and (template is None or template >= len(self.model.sweeps)):
+            QtWidgets.QMessageBox.about(self,'Error',"Select a template sweep first")
+            return False
+        return True
 
-        xmin = trigger_information['xmin']
-        xmax = trigger_information['xmax']
-        y = trigger_information['y']
-
-        highband = band_information['highband']
-        lowband = band_information['lowband']
-
-        for sweep in self.model.sweeps:
-            s = pass_filter(sweep.data, lowband, highband, sample_rate=sweep.sample_rate)
-            s = s[(sweep.time>=xmin) & (sweep.time<=xmax)]
-
-            if sweep.was_moved_by_user is False:
-                if (s > y).sum():
-                    sweep.group = SignalGroup.ACTIVITY
-                    sweep.was_moved_by_user = False # Reset this manually
-                else:
-                    sweep.group = SignalGroup.NOISE
-                    sweep.was_moved_by_user = False # Reset this manually
+    def autosort_sweeps(self):
+        if self.apply_settings_to_model():
+            try:
+                self.model.autosort()
+            except Exception as e:
+                QtWidgets.QMessageBox.about(self,'Error',str(e))
+
+    def set_template_sweep(self):
+        sweep = self.graph_widget.sweep
+        if sweep is None or sweep not in self.model.sweeps:
+            QtWidgets.QMessageBox.about(self,'Error',"Select a sweep to use as the template")
+            return
+
+        self.model.template_sweep_index = self.model.sweeps.index(sweep)
+        self.settings_widget.template_label.setText(sweep.label)
+
+    def toggle_watch(self, checked):
+        if not checked:
+            self.watch_timer.stop()
+            self.folder_watcher = None
+            self.watch_folder_layout.status_label.setText("")
+            return
+
+        if not Path(self.watch_folder_layout.value).is_dir():
+            QtWidgets.QMessageBox.about(self,'Error',"Invalid folder path")
+            self.watch_folder_layout.watch_button.setChecked(False)
+            return
+
+        # Refuse to start with settings that cannot sort, e.g. the template engine without a template
+        if not self.apply_settings_to_model():
+            self.watch_folder_layout.watch_button.setChecked(False)
+            return
+
+        save_location = self.save_file_widget.value or None
+        self.folder_watcher = FolderWatcher(self.model, self.watch_folder_layout.value, save_location)
+        self.folder_watcher.on_file_processed.connect(self.on_watch_file_processed)
+        self.watch_timer.start()
+        self.poll_watch_folder()
+
+    def poll_watch_folder(self):
+        # Sort new sweeps with whatever the settings are right now, stop if they became invalid
+        if self.folder_watcher is None:
+            return
+        if not self.apply_settings_to_model():
+            self.watch_folder_layout.watch_button.setChecked(False)
+            return
+        self.folder_watcher.poll()
+
+    def on_watch_file_processed(self, filepath, count):
+        self.watch_folder_layout.status_label.setText(f"{Path(filepath).name}: +{count} sweeps")
+        if count == len(self.model.sweeps):
+            self.update_channels()
+            self.reset_plot_limits()
 
 
 class MainWindow(QtWidgets.QMainWindow):
-    def __init__(self):
+    def __init__(self, renderer='matplotlib', memory_budget=None, storage='float32'):
         super().__init__()
         self.setWindowTitle("Electrophysiology Sorting Hat")
-        view = View()
+        view = View(renderer, memory_budget, storage)
         self.setCentralWidget(view)
 
 
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
+    parser = argparse.ArgumentParser(prog="ephys_sorting_hat")
+    parser.add_argument('--renderer', choices=list(RENDERERS), default='matplotlib',
+        help="Trace view backend; qpainter draws natively for lower latency")
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+        help="Keep at most this much sweep data in memory, re-reading evicted sweeps from the file")
+    parser.add_argument('--storage', choices=['float64', 'float32', 'int16'], default='float32',
+        help="How samples are kept in memory; int16 keeps the file's raw values and a scale factor")
+    parser.add_argument('--watch', metavar='FOLDER',
+        help="Run headless, sorting new sweeps from .abf files as they appear in FOLDER")
+    parser.add_argument('--events', metavar='FILE',
+        help="Run headless, writing the threshold crossings of a long .abf recording to <name>_events.csv")
+    parser.add_argument('--event-channel', type=int, default=0, help="Channel searched for events")
+    parser.add_argument('--dead-time', type=float, default=0.01,
+        help="Crossings this soon (s) after an event are not counted")
+    parser.add_argument('--output', metavar='FOLDER', help="Where the watch and events modes write their outputs")
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL_MS / 1000, help="Watch polling interval (s)")
+    parser.add_argument('--lowband', type=float, default=2)
+    parser.add_argument('--highband', type=float, default=100)
+    parser.add_argument('--trigger', type=float, default=10, help="Bandpass trigger (pA)")
+    parser.add_argument('--trigger-xmin', type=float, default=0.0)
+    parser.add_argument('--trigger-xmax', type=float, default=0.1)
+    parser.add_argument('--detector', choices=list(DETECTORS), default='bandpass')
+    parser.add_argument('--dvdt-trigger', type=float, default=5.0, help="dV/dt trigger (pA/ms)")
+    parser.add_argument('--template-sweep', type=int, help="Session index of the template sweep")
+    parser.add_argument('--template-threshold', type=float, default=0.8, help="Template min. correlation")
+    parser.add_argument('--clusters', type=int, default=2, help="Number of k-means clusters")
+    parser.add_argument('--channels', type=int, nargs='+', default=[0], help="Channels used for detection")
+    parser.add_argument('--channel-rule', choices=['any', 'all'], default='any',
+        help="A sweep is activity if any or all of its detection channels are")
+    args, qt_args = parser.parse_known_args()
+    if args.detector == 'template' and args.template_sweep is None:
+        parser.error("--detector template needs --template-sweep")
+    if args.template_sweep is not None and args.template_sweep < 0:
+        parser.error("--template-sweep must be a session index (0 or more)")
+    memory_budget = None if args.memory_budget is None else int(args.memory_budget * 2**20)
+
+    if args.events:
+        model = Model(memory_budget, args.storage)
+        model.lowband = args.lowband
+        model.highband = args.highband
+        model.trigger_ysmoothed = args.trigger
+        model.event_dead_time = args.dead_time
+
+        start = time.perf_counter()
+        events = model.find_events(args.events, args.event_channel)
+        elapsed = time.perf_counter() - start
+        abf = pyabf.ABF(args.events, loadData=False)
+        duration = abf_sample_count(abf) / abf.sampleRate
+        outfile = Path(args.output or Path(args.events).parent) / f"{Path(args.events).stem}_events.csv"
+        events.to_csv(outfile, index=False)
+        print(f"{len(events)} events in {duration:.1f} s of recording, found in {elapsed:.1f} s. Written to {outfile}")
+        sys.exit()
+
+    if args.watch:
+        model = Model(memory_budget, args.storage)
+        model.lowband = args.lowband
+        model.highband = args.highband
+        model.trigger_ysmoothed = args.trigger
+        model.trigger_xmin = args.trigger_xmin
+        model.trigger_xmax = args.trigger_xmax
+        model.detector_name = args.detector
+        model.dvdt_threshold = args.dvdt_trigger
+        model.template_sweep_index = args.template_sweep
+        model.template_threshold = args.template_threshold
+        model.n_clusters = args.clusters
+        model.detection_channels = args.channels
+        model.channel_rule = args.channel_rule
+
+        if args.output:
+            # A restarted watch continues after the sweeps it already wrote
+            model.resume_incremental(args.output)
+        watcher = FolderWatcher(model, args.watch, args.output)
+        watcher.on_file_processed.connect(lambda filepath, count: print(
+            f"{filepath}: +{count} sweeps. {format_memory_stats(model.memory_stats())}"))
+        watcher.run(args.interval)
+        sys.exit()
+
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
     icon_path = str(Path(__file__).parent / 'hat-wizard-solid.png')
     icon = QtGui.QIcon(icon_path)
     app.setWindowIcon(icon)
     
-    w = MainWindow()
+    w = MainWindow(args.renderer, memory_budget, args.storage)
     w.show()
     app.exec()
\ No newline at end of file
@@ -1,29 +1,699 @@
+import os
+import sys
+import time
 import numpy as np
 import pyabf
 import pandas as pd
 import pickle
+import struct
 
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from pathlib import Path
 from enum import Enum
 from PyQt6 import QtCore
 from PyQt6.QtCore import QObject
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak process memory is not reported there
+    resource = None
+
 class SignalGroup(Enum):
     NOISE = 0
     ACTIVITY = 1
 
+def pass_filter(data, lowband, upperband, sample_rate):
+    """Band-pass by zeroing Fourier coefficients outside [lowband, upperband] Hz
+
+    Filters along the last axis, so a (sweeps x samples) matrix is filtered in one pass.
+    """
+    data = np.asarray(data)
+    n = data.shape[-1]
+    upperband_index = int(upperband * n / sample_rate)
+    lowband_index = int(lowband * n / sample_rate)
+
+    fsig = np.fft.rfft(data, axis=-1)
+    fsig[..., upperband_index + 1:] = 0
+    fsig[..., :lowband_index] = 0
+    return np.fft.irfft(fsig, n=n, axis=-1)
+
+def fir_bandpass(lowband, upperband, sample_rate, transition=None):
+    """Linear-phase FIR band-pass for [lowband, upperband] Hz, the streaming counterpart of `pass_filter`
+
+    A Hamming-windowed sinc whose band edges are `transition` Hz wide (by default
+    the width of the low band, so that it is still resolved). A lowband of 0 gives
+    a low-pass. The number of taps is about 3.3 * sample_rate / transition.
+    """
+    if transition is None:
+        transition = lowband if lowband > 0 else upperband / 4
+    # Keep the filter shorter than 2**16 taps
+    transition = max(transition, 3.3 * sample_rate / 2**16)
+
+    n_taps = int(np.ceil(3.3 * sample_rate / transition)) | 1
+    n = np.arange(n_taps) - (n_taps - 1) / 2
+    high = min(upperband, sample_rate / 2) / sample_rate
+    low = max(lowband, 0) / sample_rate
+    taps = 2 * high * np.sinc(2 * high * n) - 2 * low * np.sinc(2 * low * n)
+    return taps * np.hamming(n_taps)
+
+class OverlapSaveFilter:
+    """FIR filter for a signal that arrives in blocks, using overlap-save FFT convolution
+
+    Each call filters the next block of samples and returns as many output samples,
+    delayed by `delay` samples (half the filter length); `flush` returns the last
+    `delay` outputs. Memory is set by the filter length, not by how long the
+    signal is. The signal is extended with its first and last values at the ends.
+    """
+    def __init__(self, taps, fft_size=None):
+        self.taps = np.asarray(taps, dtype=float)
+        self.delay = (len(self.taps) - 1) // 2
+        if fft_size is None:
+            fft_size = 2 ** max(int(np.ceil(np.log2(8 * len(self.taps)))), 12)
+        self.fft_size = fft_size
+        self.step = fft_size - len(self.taps) + 1
+        self.response = np.fft.rfft(self.taps, fft_size)
+        self.history = None
+        self.last = 0.0
+
+    def __call__(self, block):
+        block = np.asarray(block, dtype=float)
+        if len(block) == 0:
+            return block
+        if self.history is None:
+            self.history = np.full(len(self.taps) - 1, block[0])
+
+        m = len(self.history)
+        buffer = np.concatenate([self.history, block])
+        out = np.empty(len(block))
+        for start in range(0, len(block), self.step):
+            segment = buffer[start:start + self.step + m]
+            filtered = np.fft.irfft(np.fft.rfft(segment, self.fft_size) * self.response, self.fft_size)
+            out[start:start + len(segment) - m] = filtered[m:len(segment)]
+
+        self.history = buffer[len(buffer) - m:]
+        self.last = block[-1]
+        return out
+
+    def flush(self):
+        return self(np.full(self.delay, self.last))
+
+FEATURE_COLUMNS = ['peak', 'peak_latency', 'max_dvdt', 'baseline_mean', 'baseline_sd', 'rms_noise', 'area', 'band_power']
+
+def compute_features(data, sample_rate, lowband, highband, trigger_xmin, trigger_xmax, baseline_xmin=None, baseline_xmax=None):
+    """Per-sweep features of a (sweeps x samples) matrix, computed in one batched pass
+
+    - peak, peak_latency: maximum of the band-passed signal within the trigger window, and its time (s)
+    - max_dvdt: steepest rise of the band-passed signal within the trigger window (pA/ms)
+    - baseline_mean, baseline_sd: raw signal within the baseline window
+    - rms_noise: RMS of the band-passed signal within the baseline window
+    - area: integral of the baseline-subtracted raw signal within the trigger window (pA s)
+    - band_power: mean power of the band-passed signal
+
+    The baseline window defaults to everything outside the trigger window.
+    """
+    data = np.atleast_2d(data)
+    time = np.arange(data.shape[1]) / sample_rate
+    filtered = pass_filter(data, lowband, highband, sample_rate)
+
+    window = (time >= trigger_xmin) & (time <= trigger_xmax)
+    if baseline_xmin is None and baseline_xmax is None:
+        baseline = ~window
+    else:
+        baseline_xmin = -np.inf if baseline_xmin is None else baseline_xmin
+        baseline_xmax = np.inf if baseline_xmax is None else baseline_xmax
+        baseline = (time >= baseline_xmin) & (time <= baseline_xmax)
+    if not baseline.any():
+        baseline = np.ones_like(window)
+
+    baseline_mean = data[:, baseline].mean(axis=1)
+    columns = {
+        'baseline_mean': baseline_mean,
+        'baseline_sd': data[:, baseline].std(axis=1),
+        'rms_noise': np.sqrt(np.mean(filtered[:, baseline] ** 2, axis=1)),
+        'band_power': np.mean(filtered ** 2, axis=1),
+    }
+
+    if window.any():
+        windowed = filtered[:, window]
+        peak_index = np.argmax(windowed, axis=1)
+        columns['peak'] = windowed[np.arange(len(data)), peak_index]
+        columns['peak_latency'] = time[window][peak_index]
+        columns['area'] = (data[:, window] - baseline_mean[:, None]).sum(axis=1) / sample_rate
+    else:
+        columns['peak'] = columns['peak_latency'] = columns['area'] = np.full(len(data), np.nan)
+
+    # Slope between each sample in the window and the next
+    slope_index = np.flatnonzero(window[:-1])
+    if len(slope_index):
+        slope = (filtered[:, slope_index + 1] - filtered[:, slope_index]) * (sample_rate / 1000)
+        columns['max_dvdt'] = slope.max(axis=1)
+    else:
+        columns['max_dvdt'] = np.full(len(data), np.nan)
+
+    return pd.DataFrame({key: columns[key] for key in FEATURE_COLUMNS})
+
+def window_mask(n, sample_rate, xmin, xmax):
+    time = np.arange(n) / sample_rate
+    return (time >= xmin) & (time <= xmax)
+
+class Detector(ABC):
+    """Base class for sweep detectors
+
+    `features` maps a (sweeps x samples) matrix to a per-sweep statistic in one
+    batched computation, and `classify` turns the statistics into groups. Keeping
+    the two apart lets the features be computed a block of sweeps at a time.
+    Samples are along the last axis and any leading axes are batched over, so a
+    (channels x sweeps x samples) array is handled in the same pass. An engine
+    that does not implement all three methods cannot be constructed.
+    """
+    name = None
+    label = None
+
+    @abstractmethod
+    def features(self, data, sample_rate) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def classify(self, features):
+        """Returns the group value and score of every sweep
+        """
+
+    def detect(self, data, sample_rate):
+        return self.classify(self.features(np.atleast_2d(data), sample_rate))
+
+    @abstractmethod
+    def confidence(self, scores):
+        """How far each score is from the decision boundary, larger is more certain
+        """
+
+class ThresholdDetector(Detector):
+    """Sweeps whose score exceeds `threshold` are activity
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def classify(self, features):
+        scores = np.asarray(features, dtype=float)
+        groups = np.where(scores > self.threshold, SignalGroup.ACTIVITY.value, SignalGroup.NOISE.value)
+        return groups, scores
+
+    def confidence(self, scores):
+        return np.abs(scores - self.threshold)
+
+class FeatureThresholdDetector(ThresholdDetector):
+    """Threshold on a column of the feature table, see `compute_features`
+
+    On a single channel the model evaluates it as the query `column > @threshold`
+    on `Model.features`; `features` computes the same column for any array.
+    """
+    column = None
+
+    def __init__(self, lowband, highband, xmin, xmax, threshold):
+        super().__init__(threshold)
+        self.lowband = lowband
+        self.highband = highband
+        self.xmin = xmin
+        self.xmax = xmax
+
+    @property
+    def query(self):
+        return f"{self.column} > @threshold"
+
+    def features(self, data, sample_rate):
+        table = compute_features(
+            data.reshape(-1, data.shape[-1]), sample_rate, self.lowband, self.highband, self.xmin, self.xmax)
+        return table[self.column].to_numpy().reshape(data.shape[:-1])
+
+class BandpassThresholdDetector(FeatureThresholdDetector):
+    """Peak of the band-passed signal within the trigger window
+    """
+    name = 'bandpass'
+    label = "Bandpass threshold"
+    column = 'peak'
+
+class DerivativeThresholdDetector(FeatureThresholdDetector):
+    """Steepest rise (pA/ms) of the band-passed signal within the trigger window
+    """
+    name = 'dvdt'
+    label = "dV/dt threshold"
+    column = 'max_dvdt'
+
+class TemplateDetector(ThresholdDetector):
+    """Best Pearson correlation with an exemplar sweep's trigger window
+
+    The band-passed template is slid over each band-passed sweep by FFT
+    cross-correlation, allowing it to start up to half a window either side of
+    the trigger window start. `template` broadcasts against the data, e.g. a
+    (channels x 1 x samples) template for (channels x sweeps x samples) data.
+    """
+    name = 'template'
+    label = "Template correlation"
+
+    def __init__(self, template, lowband, highband, xmin, xmax, threshold):
+        super().__init__(threshold)
+        self.template = np.asarray(template)
+        self.lowband = lowband
+        self.highband = highband
+        self.xmin = xmin
+        self.xmax = xmax
+
+    def features(self, data, sample_rate):
+        n = data.shape[-1]
+        window = window_mask(n, sample_rate, self.xmin, self.xmax)
+        m = int(window.sum())
+        if m < 2:
+            return np.full(data.shape[:-1], -np.inf)
+
+        template = pass_filter(self.template, self.lowband, self.highband, sample_rate)[..., window]
+        template = template - template.mean(axis=-1, keepdims=True)
+        template_norm = np.linalg.norm(template, axis=-1, keepdims=True)
+        filtered = pass_filter(data, self.lowband, self.highband, sample_rate)
+
+        # Lags where the template fits inside the sweep
+        start = np.argmax(window)
+        lags = np.arange(max(start - m // 2, 0), min(start + m // 2, n - m) + 1)
+
+        # correlation[k] = sum_t x[t + k] * template[t] for every lag at once
+        nfft = 1 << int(np.ceil(np.log2(n + m)))
+        spectrum = np.fft.rfft(filtered, nfft, axis=-1) * np.conj(np.fft.rfft(template, nfft, axis=-1))
+        correlation = np.fft.irfft(spectrum, nfft, axis=-1)[..., lags]
+
+        # Sum of squared deviations of each sweep segment, from cumulative sums
+        zeros = np.zeros(filtered.shape[:-1] + (1,))
+        cumsum = np.concatenate([zeros, np.cumsum(filtered, axis=-1)], axis=-1)
+        cumsum2 = np.concatenate([zeros, np.cumsum(filtered ** 2, axis=-1)], axis=-1)
+        segment_sum = cumsum[..., lags + m] - cumsum[..., lags]
+        segment_ss = cumsum2[..., lags + m] - cumsum2[..., lags] - segment_sum ** 2 / m
+        denominator = np.sqrt(np.clip(segment_ss, 0, None)) * template_norm
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = np.where(denominator > 0, correlation / denominator, 0)
+        return r.max(axis=-1)
+
+def pca(points, n_components, sample_size=10000, seed=0):
+    """Mean and first principal components of `points`, project with `(points - mean) @ components.T`
+
+    The components are found by SVD of a random subset of at most `sample_size` rows.
+    """
+    rng = np.random.default_rng(seed)
+    sample = points if len(points) <= sample_size else points[rng.choice(len(points), sample_size, replace=False)]
+    mean = sample.mean(axis=0)
+    _, _, components = np.linalg.svd(sample - mean, full_matrices=False)
+    return mean, components[:n_components]
+
+def squared_distances(points, centers):
+    return (
+        (points ** 2).sum(axis=1)[:, None]
+        - 2 * points @ centers.T
+        + (centers ** 2).sum(axis=1)[None, :])
+
+def kmeans(points, n_clusters, n_iter=100, sample_size=10000, seed=0):
+    """Vectorized k-means, returns the cluster centers
+
+    Centers are seeded with k-means++ and fit on a random subset of at most
+    `sample_size` rows, then refined with a few passes over all points.
+    """
+    rng = np.random.default_rng(seed)
+    sample = points if len(points) <= sample_size else points[rng.choice(len(points), sample_size, replace=False)]
+
+    centers = sample[[rng.integers(len(sample))]]
+    for _ in range(1, n_clusters):
+        distance = squared_distances(sample, centers).min(axis=1).clip(0)
+        probability = distance / distance.sum() if distance.sum() > 0 else None
+        centers = np.vstack([centers, sample[rng.choice(len(sample), p=probability)]])
+
+    def update(data, centers, n_iter):
+        for _ in range(n_iter):
+            labels = squared_distances(data, centers).argmin(axis=1)
+            counts = np.bincount(labels, minlength=n_clusters)
+            sums = np.zeros_like(centers)
+            np.add.at(sums, labels, data)
+            new_centers = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+            if np.allclose(new_centers, centers):
+                break
+            centers = new_centers
+        return centers
+
+    centers = update(sample, centers, n_iter)
+    if len(sample) < len(points):
+        centers = update(points, centers, 3)
+    return centers
+
+class ClusterDetector(Detector):
+    """Unsupervised k-means over compact per-sweep feature vectors
+
+    Each sweep is described by its windowed band-passed peak, log power in
+    log-spaced frequency bands and a downsampled band-passed waveform. The
+    standardized vectors are projected with PCA and clustered; clusters whose
+    mean peak is in the upper half are activity. The score is the relative
+    margin between the nearest activity and nearest noise centers, in [-1, 1].
+
+    The first sweeps classified are used to `fit` the clusters, later ones are
+    assigned to the same centers. Pass the `fitted` result of an earlier
+    detector as `fit` to classify new sweeps against it.
+    """
+    name = 'cluster'
+    label = "K-means clustering"
+
+    def __init__(self, lowband, highband, xmin, xmax, n_clusters=2, n_bands=16, n_points=32, n_components=8, block_size=4096, fit=None):
+        self.lowband = lowband
+        self.highband = highband
+        self.xmin = xmin
+        self.xmax = xmax
+        self.n_clusters = n_clusters
+        self.n_bands = n_bands
+        self.n_points = n_points
+        self.n_components = n_components
+        self.block_size = block_size
+
+        # A fit made with other settings describes other features
+        self.fitted = fit if fit is not None and fit['settings'] == self.settings() else None
+
+    def settings(self):
+        return (self.lowband, self.highband, self.xmin, self.xmax,
+            self.n_clusters, self.n_bands, self.n_points, self.n_components)
+
+    def features(self, data, sample_rate):
+        shape = data.shape[:-1]
+        n = data.shape[-1]
+        data = data.reshape(-1, n)
+        window = window_mask(n, sample_rate, self.xmin, self.xmax)
+        bins = np.arange(n // 2 + 1)
+        band = (bins >= int(self.lowband * n / sample_rate)) & (bins <= int(self.highband * n / sample_rate))
+        edges = np.unique(np.geomspace(1, len(bins), self.n_bands + 1).astype(int) - 1)[:-1]
+        points = min(self.n_points, n)
+        length = n - n % points
+
+        # Blocks of sweeps bound the size of the complex spectra
+        rows = []
+        for start in range(0, len(data), self.block_size):
+            block = data[start:start + self.block_size]
+            spectrum = np.fft.rfft(block, axis=1)
+            band_powers = np.log1p(np.add.reduceat(np.abs(spectrum) ** 2, edges, axis=1) / n)
+
+            spectrum[:, ~band] = 0
+            filtered = np.fft.irfft(spectrum, n=n, axis=1)
+            peak = filtered[:, window].max(axis=1, keepdims=True) if window.any() else np.zeros((len(block), 1))
+            waveform = filtered[:, :length].reshape(len(block), points, -1).mean(axis=2)
+            rows.append(np.hstack([peak, band_powers, waveform]).astype(np.float32))
+
+        features = np.vstack(rows)
+        return features.reshape(shape + features.shape[-1:])
+
+    def classify(self, features):
+        shape = features.shape[:-1]
+        groups, scores = self.classify_points(np.asarray(features, dtype=np.float64).reshape(-1, features.shape[-1]))
+        return groups.reshape(shape), scores.reshape(shape)
+
+    def fit(self, features):
+        """Standardization, PCA basis, k-means centers and activity clusters of (sweeps x features) points
+
+        Returns None if there are fewer sweeps than clusters, or the clusters
+        do not split into activity and noise.
+        """
+        if len(features) < self.n_clusters:
+            return None
+
+        mean = features.mean(axis=0)
+        scale = features.std(axis=0)
+        scale = np.where(scale > 0, scale, 1)
+        pca_mean, components = pca((features - mean) / scale, min(self.n_components, features.shape[1]))
+        points = ((features - mean) / scale - pca_mean) @ components.T
+        centers = kmeans(points, self.n_clusters)
+        labels = squared_distances(points, centers).argmin(axis=1)
+
+        # Label clusters by their mean windowed peak
+        peak = features[:, 0]
+        cluster_peak = np.array([peak[labels == i].mean() if (labels == i).any() else -np.inf for i in range(self.n_clusters)])
+        finite = cluster_peak[np.isfinite(cluster_peak)]
+        is_activity = cluster_peak > (finite.min() + finite.max()) / 2
+        if not is_activity.any() or is_activity.all():
+            return None
+
+        return dict(settings=self.settings(), mean=mean, scale=scale, pca_mean=pca_mean,
+            components=components, centers=centers, is_activity=is_activity)
+
+    def classify_points(self, features):
+        if self.fitted is None:
+            self.fitted = self.fit(features)
+        if self.fitted is None:
+            return np.full(len(features), SignalGroup.NOISE.value), np.zeros(len(features))
+
+        fit = self.fitted
+        points = ((features - fit['mean']) / fit['scale'] - fit['pca_mean']) @ fit['components'].T
+        distances = np.sqrt(squared_distances(points, fit['centers']).clip(0))
+        labels = distances.argmin(axis=1)
+        is_activity = fit['is_activity']
+
+        activity_distance = distances[:, is_activity].min(axis=1)
+        noise_distance = distances[:, ~is_activity].min(axis=1)
+        total = activity_distance + noise_distance
+        scores = np.where(total > 0, (noise_distance - activity_distance) / np.where(total > 0, total, 1), 0)
+        groups = np.where(is_activity[labels], SignalGroup.ACTIVITY.value, SignalGroup.NOISE.value)
+        return groups, scores
+
+    def confidence(self, scores):
+        return np.abs(scores)
+
+DETECTORS = {
+    detector.name: detector
+    for detector in (BandpassThresholdDetector, DerivativeThresholdDetector, TemplateDetector, ClusterDetector)
+}
+
+def abf_sweep_count(abf):
+    """Number of complete sweeps currently on disk
+
+    Files that are still being acquired can be shorter than their header says.
+    """
+    sweep_bytes = abf.sweepPointCount * abf.channelCount * abf.dataPointByteSize
+    return int(min(abf.sweepCount, max(abf._fileSize - abf.dataByteStart, 0) // sweep_bytes))
+
+def read_abf_channels(abf, numbers, channels, scale=True):
+    """Read and scale the given sweeps of several channels in one pass over the file
+
+    Returns a (channel x sweep x sample) array. Only the header of `abf` needs to
+    be loaded (`pyabf.ABF(path, loadData=False)`), so the cost is proportional to
+    the number of sweeps read. With `scale=False` the samples are returned as
+    stored in the file (int16 for most files) without applying the channel gain.
+    """
+    numbers = np.asarray(numbers, dtype=int)
+    channels = list(channels)
+    if len(numbers) == 0:
+        return np.empty((len(channels), 0, abf.sweepPointCount), dtype=np.float32 if scale else abf._dtype)
+
+    raw = np.memmap(
+        abf.abfFilePath, dtype=abf._dtype, mode='r', offset=abf.dataByteStart,
+        shape=(abf_sweep_count(abf), abf.sweepPointCount, abf.channelCount))
+
+    data = np.ascontiguousarray(np.moveaxis(raw[numbers][:, :, channels], -1, 0))
+    del raw
+    return scale_abf_samples(abf, data, channels) if scale else data
+
+def abf_sample_count(abf):
+    """Number of samples per channel currently on disk, over all sweeps
+    """
+    sample_bytes = abf.channelCount * abf.dataPointByteSize
+    on_disk = max(abf._fileSize - abf.dataByteStart, 0) // sample_bytes
+    return int(min(abf.sweepCount * abf.sweepPointCount, on_disk))
+
+def read_abf_windows(abf, starts, length, channels, scale=True):
+    """Read windows of `length` samples starting at the sample indices `starts`
+
+    The recording is treated as one continuous trace (a gap-free file, or the
+    sweeps of an episodic file back to back). Returns a (channel x window x
+    sample) array like `read_abf_channels`, so a single long range is
+    `read_abf_windows(abf, [start], stop - start, channels)[:, 0]`.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    channels = list(channels)
+    raw = np.memmap(
+        abf.abfFilePath, dtype=abf._dtype, mode='r', offset=abf.dataByteStart,
+        shape=(abf_sample_count(abf), abf.channelCount))
+
+    if len(starts) == 1:
+        data = raw[starts[0]:starts[0] + length, channels].T[:, None]
+    else:
+        # A strided view of every window, so only the windows themselves are copied
+        windows = np.lib.stride_tricks.sliding_window_view(raw, length, axis=0)
+        data = np.moveaxis(windows[starts[:, None], np.asarray(channels)[None, :]], 1, 0)
+    data = np.ascontiguousarray(data)
+    del raw
+    return scale_abf_samples(abf, data, channels) if scale else data
+
+def scale_abf_samples(abf, data, channels):
+    """Convert stored samples of `channels` (along the first axis) to float32 in the channel units
+    """
+    data = data.astype(np.float32)
+    if abf._dtype == np.int16:
+        data *= np.asarray(abf._dataGain, dtype=np.float32)[channels, None, None]
+        data += np.asarray(abf._dataOffset, dtype=np.float32)[channels, None, None]
+    return data
+
+def write_abf1(filepath, blocks, n_sweeps, n_samples, sample_rate, max_value, units='pA'):
+    """Write (sweeps x samples) `blocks` as one ABF1 file, without holding all sweeps in memory
+
+    Produces the same file as `pyabf.abfWriter.writeABF1` for the stacked
+    blocks. `max_value` is the largest absolute sample, which sets the integer
+    scale, so the samples are only read once more to write them.
+    """
+    BLOCKSIZE = 512
+    HEADER_BLOCKS = 4
+    data_points = n_sweeps * n_samples
+    data_blocks = int(data_points * 2 / BLOCKSIZE) + 1
+
+    header = bytearray(HEADER_BLOCKS * BLOCKSIZE)
+    struct.pack_into('4s', header, 0, b'ABF ')
+    struct.pack_into('f', header, 4, 1.3)
+    struct.pack_into('h', header, 8, 5)
+    struct.pack_into('i', header, 10, data_points)
+    struct.pack_into('i', header, 16, n_sweeps)
+    struct.pack_into('i', header, 40, HEADER_BLOCKS)
+    struct.pack_into('h', header, 100, 0)
+    struct.pack_into('h', header, 120, 1)
+    struct.pack_into('f', header, 122, 1e6 / sample_rate)
+    struct.pack_into('i', header, 138, n_samples)
+
+    # Largest instrument scale factor whose integer range still holds `max_value`
+    resolution, adc_range = 2**15, 10
+    scale_factor = 100
+    for _ in range(10):
+        scale_factor /= 10
+        value_scale = resolution / adc_range * scale_factor
+        if 32767 / value_scale >= max_value:
+            break
+
+    struct.pack_into('i', header, 252, resolution)
+    struct.pack_into('f', header, 244, adc_range)
+    for i in range(16):
+        struct.pack_into('f', header, 922 + i * 4, scale_factor)
+        struct.pack_into('f', header, 1050 + i * 4, 1)
+        struct.pack_into('f', header, 730 + i * 4, 1)
+        struct.pack_into('8s', header, 602 + i * 8, units.ljust(8).encode())
+
+    with open(filepath, 'wb') as fp:
+        fp.write(header)
+        for block in blocks:
+            fp.write(np.trunc(block * value_scale).astype('<i2').tobytes())
+        fp.write(bytes((data_blocks + HEADER_BLOCKS) * BLOCKSIZE - fp.tell()))
+
+class EventDetector:
+    """Upward threshold crossings of the band-passed signal of a continuous recording
+
+    Feed the recording in blocks of any size with `process` and finish with
+    `flush`; each returns the sample indices of the events it found. Crossings
+    within `dead_time` seconds of the previous event are ignored.
+    """
+    def __init__(self, lowband, highband, threshold, sample_rate, dead_time=0.01):
+        self.filter = OverlapSaveFilter(fir_bandpass(lowband, highband, sample_rate))
+        self.threshold = threshold
+        self.dead_samples = int(round(dead_time * sample_rate))
+        self.position = -self.filter.delay
+        self.was_above = True
+        self.last_event = None
+
+    def process(self, block):
+        return self.crossings(self.filter(block))
+
+    def flush(self):
+        return self.crossings(self.filter.flush())
+
+    def crossings(self, filtered):
+        above = filtered > self.threshold
+        rising = above & ~np.concatenate([[self.was_above], above[:-1]])
+        candidates = np.flatnonzero(rising) + self.position
+        if len(filtered):
+            self.was_above = above[-1]
+        self.position += len(filtered)
+
+        # Output that precedes the first sample is the filter warming up
+        events = []
+        for sample in candidates[candidates >= 0]:
+            if self.last_event is None or sample - self.last_event >= self.dead_samples:
+                events.append(sample)
+                self.last_event = sample
+        return np.array(events, dtype=np.int64)
+
+def detect_abf_events(abf, lowband, highband, threshold, channel=0, dead_time=0.01, block_size=2**20):
+    """Find the events of a long recording by streaming it through an `EventDetector`
+
+    Only `block_size` samples are read at a time. Returns a table with the
+    `sample` index and `time` (s) of every event.
+    """
+    detector = EventDetector(lowband, highband, threshold, abf.sampleRate, dead_time)
+    n_samples = abf_sample_count(abf)
+    found = []
+    for start in range(0, n_samples, block_size):
+        length = min(block_size, n_samples - start)
+        found.append(detector.process(read_abf_windows(abf, [start], length, [channel])[0, 0]))
+    found.append(detector.flush())
+
+    samples = np.concatenate(found)
+    return pd.DataFrame({'sample': samples, 'time': samples / abf.sampleRate})
+
 class Sweep(QObject):
     sweep_changed = QtCore.pyqtSignal()
-    def __init__(self, number: int, data: np.ndarray, sample_rate: int, group:SignalGroup=SignalGroup.ACTIVITY):
+    def __init__(self, number: int, data: np.ndarray, sample_rate: int, group:SignalGroup=SignalGroup.ACTIVITY, n_samples: int=None):
         super().__init__()
 
         self.number: int = number
-        self.data: np.ndarray = data
+        self._data: np.ndarray = data
         self._group: SignalGroup = group
         self.sample_rate: int = sample_rate
-        self.time: np.ndarray = np.arange(len(data)) / self.sample_rate
+        self.n_samples: int = len(data) if data is not None else n_samples
         self.was_moved_by_user: bool = False
         self.label = f"Sweep {self.number}"
+        self.source = None
+
+        # Reads the samples of another channel, set by the model for multi-channel files
+        self.channel_loader = None
+
+        # (gain, offset) when the samples are kept as the file's int16 values
+        self.scale = None
+
+        # Re-decodes the samples from the source file once they were evicted
+        self.data_loader = None
+        self.cache: SweepCache = None
+        self.was_evicted = False
+
+    @property
+    def data(self) -> np.ndarray:
+        data = self._data
+        if data is None:
+            data = self._data = self.data_loader(self.number)
+            if self.cache is not None:
+                # Only a sweep that was evicted before is re-decoded, others are read for the first time
+                self.cache.add(self, reload=self.was_evicted)
+        elif self.cache is not None:
+            self.cache.touch(self)
+
+        if self.scale is None:
+            return data
+        gain, offset = self.scale
+        return data * np.float32(gain) + np.float32(offset)
+
+    @data.setter
+    def data(self, value: np.ndarray):
+        self._data = value
+        self.n_samples = len(value)
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self._data is None else self._data.nbytes
+
+    @property
+    def time(self) -> np.ndarray:
+        return np.arange(self.n_samples) / self.sample_rate
+
+    def evict(self):
+        self._data = None
+        self.was_evicted = True
+
+    def channel_data(self, channel: int) -> np.ndarray:
+        if channel == 0 or self.channel_loader is None:
+            return self.data
+        return self.channel_loader(self.number, channel)
 
     @property
     def group(self):
@@ -36,41 +706,215 @@ class Sweep(QObject):
         self.sweep_changed.emit()
         print("Emit sweep changed")
 
-    def to_dict(self):
-        return {
+    def to_dict(self, samples=True):
+        """With `samples` False the sweep refers to its number in `source` instead of listing its samples
+        """
+        info = {
             'sweep_number': int(self.number),
-            'data': self.data.tolist(),
             'group': int(self.group.value),
             'sample_rate': int(self.sample_rate),
-            'time': self.time.tolist(), 
+            'n_samples': int(self.n_samples),
             'was_moved_by_user': bool(self.was_moved_by_user),
             'label': str(self.label)
         }
+        if samples:
+            info['data'] = self.data.tolist()
+            info['time'] = self.time.tolist()
+        else:
+            info['source'] = str(self.source)
+        return info
 
     @staticmethod
     def from_dict(**kwargs):
         sweep = Sweep(
             number = int(kwargs['sweep_number']),
-            data = np.array(kwargs['data']),
+            data = np.array(kwargs['data']) if 'data' in kwargs else None,
             group = SignalGroup(kwargs['group']),
-            sample_rate = int(kwargs['sample_rate'])
+            sample_rate = int(kwargs['sample_rate']),
+            n_samples = kwargs.get('n_samples')
         )
         print(SignalGroup(kwargs['group']))
         sweep.was_moved_by_user = True
         return sweep
     
 
+class SweepCache:
+    """Least recently used set of sweeps whose samples are resident in memory
+
+    Once the resident samples exceed `budget` bytes, sweeps that can be
+    re-decoded from their source file are evicted, oldest first. The sweep that
+    is currently shown is never evicted. Without a budget nothing is evicted
+    and the cache only keeps count.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.shown: Sweep = None
+        self.resident_bytes = 0
+        self.peak_resident_bytes = 0
+        self.evictions = 0
+        self.reloads = 0
+        self._sweeps = OrderedDict()
+
+    def add(self, sweep: Sweep, reload=False):
+        self.resident_bytes += sweep.nbytes
+        self.peak_resident_bytes = max(self.peak_resident_bytes, self.resident_bytes)
+        self.reloads += reload
+
+        # Sweeps that cannot be reloaded are only counted
+        if sweep.data_loader is not None:
+            self._sweeps[id(sweep)] = sweep
+            self.evict()
+
+    def touch(self, sweep: Sweep):
+        if id(sweep) in self._sweeps:
+            self._sweeps.move_to_end(id(sweep))
+
+    def evict(self):
+        if self.budget is None:
+            return
+
+        while self.resident_bytes > self.budget and len(self._sweeps) > 1:
+            key, sweep = self._sweeps.popitem(last=False)
+            if sweep is self.shown:
+                self._sweeps[key] = sweep
+                continue
+
+            self.resident_bytes -= sweep.nbytes
+            sweep.evict()
+            self.evictions += 1
+
+    def stats(self):
+        stats = {
+            'resident_bytes': self.resident_bytes,
+            'peak_resident_bytes': self.peak_resident_bytes,
+            'budget_bytes': self.budget,
+            'evictions': self.evictions,
+            'reloads': self.reloads,
+        }
+        if resource is not None:
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            stats['peak_process_bytes'] = peak if sys.platform == 'darwin' else peak * 1024
+        return stats
+
+class LabelJournal:
+    """Append-only log of sweep group changes, stored next to the source file
+
+    Every change is a fixed-size record (sweep number, group, moved by user,
+    timestamp). Records are flushed to the OS on every append and synced to
+    disk at most every `sync_interval` seconds. Once the log holds more than
+    `compact_ratio` records per labelled sweep it is rewritten, keeping only
+    the latest record of each sweep, and atomically swapped in.
+    """
+    # 64-bit sweep numbers, since event sweeps are numbered by their sample in the recording
+    RECORD = np.dtype({
+        'names': ['sweep', 'group', 'user', 'timestamp'],
+        'formats': ['<u8', 'u1', 'u1', '<f8'],
+        'offsets': [0, 8, 9, 16],
+        'itemsize': 24})
+    SUFFIX = '.labels'
+
+    def __init__(self, source, sync_interval=5.0, compact_ratio=4, compact_min=4096):
+        self.path = Path(f"{source}{self.SUFFIX}")
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self._last_sync = time.monotonic()
+
+        # Drop a partial record left by a crash so new records stay aligned
+        if self.path.exists() and self.path.stat().st_size % self.RECORD.itemsize:
+            with open(self.path, 'r+b') as fp:
+                fp.truncate(self.path.stat().st_size // self.RECORD.itemsize * self.RECORD.itemsize)
+
+        records = self.read()
+        self._count = len(records)
+        self._labelled = len(np.unique(records['sweep']))
+        self._fp = None
+
+    def read(self):
+        """All complete records in the journal, oldest first
+        """
+        if not self.path.exists():
+            return np.empty(0, dtype=self.RECORD)
+
+        raw = self.path.read_bytes()
+        # A crash can leave a partially written record at the end
+        raw = raw[:len(raw) - len(raw) % self.RECORD.itemsize]
+        return np.frombuffer(raw, dtype=self.RECORD)
+
+    def replay(self):
+        """Latest record of every sweep in the journal
+        """
+        records = self.read()[::-1]
+        _, latest = np.unique(records['sweep'], return_index=True)
+        return records[latest]
+
+    def append(self, numbers, groups, user):
+        records = np.empty(len(numbers), dtype=self.RECORD)
+        records['sweep'] = numbers
+        records['group'] = groups
+        records['user'] = user
+        records['timestamp'] = time.time()
+
+        if self._fp is None:
+            self._fp = open(self.path, 'ab')
+        self._fp.write(records.tobytes())
+        self._fp.flush()
+        self._count += len(records)
+
+        if time.monotonic() - self._last_sync > self.sync_interval:
+            os.fsync(self._fp.fileno())
+            self._last_sync = time.monotonic()
+
+        if self._count > max(self.compact_min, self.compact_ratio * self._labelled):
+            self.compact()
+
+    def compact(self):
+        self.close()
+        records = self.replay()
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'wb') as fp:
+            fp.write(records.tobytes())
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self._count = self._labelled = len(records)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+            self._fp = None
+
 class Model(QObject):
     on_sweeps_changed = QtCore.pyqtSignal(list)
+    # Indices of the sweeps whose group changed, for updates that do not need a full refresh
+    on_groups_changed = QtCore.pyqtSignal(object)
+    # Indices of sweeps added to the end of the session
+    on_sweeps_appended = QtCore.pyqtSignal(object)
     on_signal_detect_complete = QtCore.pyqtSignal()
     on_save_complete = QtCore.pyqtSignal()
     on_load_complete = QtCore.pyqtSignal()
+    # The sweeps were dropped to start a new session
+    on_session_cleared = QtCore.pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, memory_budget=None, storage='float32'):
+        """
+        memory_budget: bytes of sweep samples kept in memory, sweeps of .abf
+            files are read on demand and evicted when it is exceeded. None keeps
+            everything resident.
+        storage: how samples are kept, 'float64', 'float32' or 'int16' (the
+            file's raw values and a scale factor, if the file stores integers)
+        """
         super().__init__()
         self._file_location = None
         self._save_location = None
 
+        self.memory_budget = memory_budget
+        self.storage = storage
+        self.cache = SweepCache(memory_budget)
+
         # Fourier filter parameters
         self.lowband = 5
         self.highband = 5
@@ -79,13 +923,65 @@ class Model(QObject):
         self.trigger_xmin = 0
         self.trigger_xmax = 1.0
 
+        # Detection engine, see DETECTORS
+        self.detector_name = 'bandpass'
+        self.dvdt_threshold = 5.0
+        self.template_threshold = 0.8
+        self.template_sweep_index = None
+
+        self.n_clusters = 2
+        # Clusters of the last full cluster autosort, new sweeps are assigned to them
+        self.cluster_fit = None
+
+        # Detector score of each sweep and its distance from the decision boundary, nan until detected
+        self.scores = np.array([])
+        self.confidence = np.array([])
+        self.order_by_confidence = False
+
+        # Backing rows of `scores` and `confidence`, grown by doubling as sweeps are appended
+        self._score_storage = np.empty((2, 0))
+
+        # Defaults to everything outside of the trigger window
+        self.baseline_xmin = None
+        self.baseline_xmax = None
+
         self.sample_frequency = 1000
         self.sample_rate = None
 
+        # Per-sweep feature table, indexed by position in `sweeps`
+        self.features: pd.DataFrame = None
+
         # Load the sweeps into here
         self.sweeps = []
         self.active_sweep_index = None
 
+        # Number of sweeps already in the session from each file (by resolved path), for incremental loading
+        self.sweeps_seen = {}
+
+        # Label journal of each source file
+        self.journals = {}
+
+        # Header of each source .abf file, to read channels lazily
+        self.abf_headers = {}
+        self.channel_names = ["Channel 0 (pA)"]
+        self.channel_units = ["pA"]
+
+        # Channels used for detection and how their groups are combined, 'any' or 'all'
+        self.detection_channels = [0]
+        self.channel_rule = 'any'
+
+        # Events of a continuous recording, see `load_events`. Each event sweep
+        # source maps to the (samples before the event, window length) it reads.
+        self.events: pd.DataFrame = None
+        self.event_windows = {}
+        self.event_dead_time = 0.01
+
+        # Undo and redo steps of user moves, each the (indices, groups, moved by user)
+        # arrays of the sweeps before the step
+        self.undo_stack = []
+        self.redo_stack = []
+        self.undo_limit = 100
+
     def reset_signals(self):
         """Reset signals to all be noise
         """
@@ -118,25 +1014,58 @@ class Model(QObject):
         self.active_sweep.group = value
         self.on_sweeps_changed.emit(self.sweeps)
 
-    def load_file(self, filepath):
+    def clear_session(self, filepath):
         self._file_location = filepath
         self.sweeps = []
+        self.sweeps_seen = {}
+        self.close_journals()
+        self.features = None
+        self.scores = np.array([])
+        self.confidence = np.array([])
+        self._score_storage = np.empty((2, 0))
+        self.cluster_fit = None
+        self.template_sweep_index = None
+        self.abf_headers = {}
+        self.detection_channels = [0]
+        self.events = None
+        self.event_windows = {}
+        self.undo_stack = []
+        self.redo_stack = []
+        self.cache = SweepCache(self.memory_budget)
+        self.on_session_cleared.emit()
+
+    def load_file(self, filepath):
+        self.clear_session(filepath)
 
         filename, ext = Path(filepath).parts[-1].split('.')
         if ext.lower() == 'abf':
-            abf = pyabf.ABF(self._file_location)
+            # Only the first channel is read up front, others on demand.
+            # With a memory budget nothing is read until a sweep is used.
+            # Sources are resolved paths, so that a watched folder finds this file's sweeps already loaded
+            source = str(Path(filepath).resolve())
+            abf = pyabf.ABF(source, loadData=False)
             self.sample_rate = abf.sampleRate
+            self.set_channels(abf)
+            self.abf_headers[source] = abf
+            load = self.make_channel_loader(source)
 
-            for sweep_number in abf.sweepList:
-                abf.setSweep(sweep_number)
-                data = abf.sweepY
-                sweep = Sweep(sweep_number, data, sample_rate=self.sample_rate)
-                sweep.sweep_changed.connect(lambda: self.on_sweeps_changed.emit(self.sweeps))
+            numbers = np.arange(abf_sweep_count(abf))
+            data, scale = self.read_stored(source, [] if self.memory_budget else numbers)
+            for sweep_number in numbers:
+                sweep = Sweep(sweep_number, data[sweep_number] if len(data) else None,
+                    sample_rate=self.sample_rate, n_samples=abf.sweepPointCount)
+                sweep.source = source
+                sweep.channel_loader = load
+                self.add_to_cache(sweep, scale)
+                self.connect_sweep(sweep)
                 self.sweeps.append(sweep)
 
                 # Emit event here to show that items are loading
                 self.on_sweeps_changed.emit(self.sweeps)
 
+            self.sweeps_seen[source] = len(numbers)
+            self.replay_journal(self.sweeps)
+            self.on_sweeps_changed.emit(self.sweeps)
             self.on_load_complete.emit()
 
         elif ext.lower() == 'pkl':
@@ -144,53 +1073,691 @@ class Model(QObject):
                 data = pickle.load(fp)
 
             self.sample_rate = data['meta']['sample_rate']
+            self.channel_names = ["Channel 0 (pA)"]
+            self.channel_units = ["pA"]
+            self.event_windows = {source: tuple(window) for source, window in data['meta'].get('event_windows', {}).items()}
             for sweep_data in data['data']:
                 sweep = Sweep.from_dict(**sweep_data)
-                sweep.sweep_changed.connect(lambda: self.on_sweeps_changed.emit(self.sweeps))
+                if 'source' in sweep_data:
+                    # Samples are read from the source .abf file, like a loaded file
+                    self.open_source(sweep_data['source'])
+                    sweep.source = sweep_data['source']
+                    sweep.channel_loader = self.make_channel_loader(sweep.source)
+                else:
+                    sweep.source = str(filepath)
+                    sweep.data = sweep.data.astype('float64' if self.storage == 'float64' else 'float32')
+                    self.add_to_cache(sweep)
+                self.connect_sweep(sweep)
                 self.sweeps.append(sweep)
                 self.on_sweeps_changed.emit(self.sweeps)
 
+            self.read_source_sweeps(self.sweeps)
+            by_source = {}
+            for sweep in self.sweeps:
+                by_source.setdefault(sweep.source, []).append(sweep)
+            for sweeps in by_source.values():
+                self.replay_journal(sweeps)
+            self.on_sweeps_changed.emit(self.sweeps)
             self.on_load_complete.emit()
         else:
             raise Exception(f"Could not recognize filetype '{ext}'")
 
-    def low_pass_filter(self, data):
-        bandlimit_index = int(self.bandlimit * data.size / self.sample_rate)
-        fsig = np.fft.fft(data)
-        for i in range(bandlimit_index + 1, len(fsig) - bandlimit_index):
-            fsig[i] = 0
-            
-        data_filtered = np.fft.ifft(fsig)
-        return np.real(data_filtered)
-        
-    def fourier_sort(self):
-        self.low_pass_filter()
-        for sweep in self.sweeps:
-            s = sweep.data
-            s = s[self.signal_start:self.signal_stop]
-            s = self.low_pass_filter(s)
-            s = pd.Series(s)
-            sweep.group = SignalGroup.ACTIVITY if (s > self.trigger).sum() > 0 else SignalGroup.NOISE
-        
+    def set_channels(self, abf):
+        names = [name.strip('\x00 ') or f"Channel {i}" for i, name in enumerate(abf.adcNames)]
+        self.channel_units = [units.strip('\x00 ') or "?" for units in abf.adcUnits]
+        self.channel_names = [f"{name} ({units})" for name, units in zip(names, self.channel_units)]
+
+    def open_source(self, source):
+        """Read the header of a sweep source, an .abf path or the events of one (`<path>#events`)
+        """
+        if source not in self.abf_headers:
+            abf = pyabf.ABF(source.removesuffix('#events'), loadData=False)
+            if len(self.abf_headers) == 0:
+                self.set_channels(abf)
+            self.abf_headers[source] = abf
+        return self.abf_headers[source]
+
+    def read_source_sweeps(self, sweeps):
+        """Attach the .abf sweeps that have no samples to the cache, reading them now unless there is a memory budget
+        """
+        by_source = {}
+        for sweep in sweeps:
+            if sweep._data is None and sweep.source in self.abf_headers:
+                by_source.setdefault(sweep.source, []).append(sweep)
+
+        for source, source_sweeps in by_source.items():
+            numbers = [sweep.number for sweep in source_sweeps]
+            data, scale = self.read_stored(source, [] if self.memory_budget else numbers)
+            for i, sweep in enumerate(source_sweeps):
+                sweep._data = data[i] if len(data) else None
+                self.add_to_cache(sweep, scale)
+
+    def read_source(self, source, numbers, channels, scale=True):
+        """Read the sweeps `numbers` of an .abf source as a (channel x sweep x sample) array
+
+        For event sweeps the numbers are the sample indices of the events.
+        """
+        abf = self.abf_headers[source]
+        if source in self.event_windows:
+            before, length = self.event_windows[source]
+            return read_abf_windows(abf, np.asarray(numbers, dtype=np.int64) - before, length, channels, scale)
+        return read_abf_channels(abf, numbers, channels, scale)
+
+    def read_stored(self, source, numbers):
+        """Samples of the first channel in the storage format, and their (gain, offset) if kept as int16
+        """
+        abf = self.abf_headers[source]
+        if self.storage == 'int16' and abf._dtype == np.int16:
+            return self.read_source(source, numbers, [0], scale=False)[0], (abf._dataGain[0], abf._dataOffset[0])
+
+        data = self.read_source(source, numbers, [0])[0]
+        return data.astype('float64' if self.storage == 'float64' else 'float32', copy=False), None
+
+    def add_to_cache(self, sweep: Sweep, scale=None):
+        """Track the memory of a sweep, and let it be evicted if it comes from an .abf file
+        """
+        sweep.scale = scale
+        sweep.cache = self.cache
+        if sweep.source in self.abf_headers:
+            source = sweep.source
+            sweep.data_loader = lambda number: self.read_stored(source, [number])[0][0]
+        if sweep._data is not None:
+            self.cache.add(sweep)
+
+    def show_sweep(self, sweep: Sweep):
+        """Keep the samples of the shown sweep resident
+        """
+        self.cache.shown = sweep
+
+    def memory_stats(self):
+        return self.cache.stats()
+
+    def make_channel_loader(self, source):
+        def load(number, channel):
+            return self.read_source(source, [number], [channel])[0, 0]
+        return load
+
+    def connect_sweep(self, sweep: Sweep):
+        sweep.sweep_changed.connect(lambda: self.on_sweeps_changed.emit(self.sweeps))
+        sweep.sweep_changed.connect(lambda: self.record_groups([sweep]))
+
+    def journal(self, source) -> LabelJournal:
+        """Label journal of a source file, None if it cannot be written
+        """
+        if source not in self.journals:
+            try:
+                self.journals[source] = LabelJournal(source)
+            except OSError as e:
+                print(f"Label journal disabled for '{source}': {e}")
+                self.journals[source] = None
+        return self.journals[source]
+
+    def record_groups(self, sweeps):
+        """Append the current group of `sweeps` to their label journals
+        """
+        by_source = {}
+        for sweep in sweeps:
+            by_source.setdefault(sweep.source, []).append(sweep)
+
+        for source, source_sweeps in by_source.items():
+            journal = self.journal(source) if source is not None else None
+            if journal is None:
+                continue
+            try:
+                journal.append(
+                    [s.number for s in source_sweeps],
+                    [s.group.value for s in source_sweeps],
+                    [s.was_moved_by_user for s in source_sweeps])
+            except OSError as e:
+                print(f"Could not write label journal '{journal.path}': {e}")
+
+    def replay_journal(self, sweeps):
+        """Restore the journaled groups of `sweeps`, which must come from a single source file
+        """
+        if len(sweeps) == 0 or sweeps[0].source is None:
+            return
+
+        journal = self.journal(sweeps[0].source)
+        if journal is None:
+            return
+
+        by_number = {sweep.number: sweep for sweep in sweeps}
+        for record in journal.replay():
+            sweep = by_number.get(int(record['sweep']))
+            if sweep is not None:
+                sweep._group = SignalGroup(int(record['group']))
+                sweep.was_moved_by_user = bool(record['user'])
+
+    def close_journals(self):
+        for journal in self.journals.values():
+            if journal is not None:
+                journal.close()
+        self.journals = {}
+
+    def append_file(self, filepath):
+        """Append the sweeps of an .abf file that are not yet in the session
+
+        Can be called repeatedly on a file that is still growing; only the new
+        sweeps are read from disk. Returns the list of new sweeps, and emits
+        `on_sweeps_appended` with their indices.
+        """
+        filepath = str(Path(filepath).resolve())
+        abf = pyabf.ABF(filepath, loadData=False)
+        if self.sample_rate is not None and abf.sampleRate != self.sample_rate:
+            raise Exception(f"Sample rate of '{filepath}' ({abf.sampleRate}) does not match the session ({self.sample_rate})")
+
+        # Keep the latest header, a growing file has more sweeps
+        self.abf_headers[filepath] = abf
+        start = self.sweeps_seen.get(filepath, 0)
+        data, scale = self.read_stored(filepath, np.arange(start, abf_sweep_count(abf)))
+        if len(data) == 0:
+            return []
+
+        self.sample_rate = abf.sampleRate
+        if self._file_location is None:
+            self._file_location = filepath
+        if len(self.sweeps) == 0:
+            self.set_channels(abf)
+
+        load = self.make_channel_loader(filepath)
+
+        new_sweeps = []
+        for sweep_number, sweep_data in enumerate(data, start):
+            # Copy rows out of the block so that evicting a sweep frees its memory
+            sweep_data = sweep_data.copy() if self.memory_budget is not None else sweep_data
+            sweep = Sweep(sweep_number, sweep_data, sample_rate=self.sample_rate)
+            sweep.source = filepath
+            sweep.label = f"{abf.abfID} Sweep {sweep_number}"
+            sweep.channel_loader = load
+            self.add_to_cache(sweep, scale)
+            self.connect_sweep(sweep)
+            new_sweeps.append(sweep)
+
+        self.replay_journal(new_sweeps)
+        self.sweeps.extend(new_sweeps)
+        self.sweeps_seen[filepath] = start + len(new_sweeps)
+        self.on_sweeps_appended.emit(np.arange(len(self.sweeps) - len(new_sweeps), len(self.sweeps)))
+        return new_sweeps
+
+    def find_events(self, filepath, channel=0):
+        """Threshold crossings of the band-passed `channel` of a long .abf recording
+
+        Uses the band and trigger settings and streams the file in blocks, so
+        memory does not grow with the length of the recording.
+        """
+        abf = pyabf.ABF(str(filepath), loadData=False)
+        return detect_abf_events(
+            abf, self.lowband, self.highband, self.trigger_ysmoothed, channel, self.event_dead_time)
+
+    def load_events(self, filepath, before=0.01, after=0.04, channel=0):
+        """Load a continuous recording as one sweep per event, `before` to `after` seconds around it
+
+        The event sweeps can be sorted like any other, their time axis starts
+        `before` seconds ahead of the crossing. Events too close to either end
+        of the recording for a full window are left out.
+        """
+        filepath = str(filepath)
+        self.clear_session(filepath)
+        abf = pyabf.ABF(filepath, loadData=False)
+        self.sample_rate = abf.sampleRate
+        self.set_channels(abf)
+
+        events = self.find_events(filepath, channel)
+        before, length = int(round(before * self.sample_rate)), int(round((before + after) * self.sample_rate))
+        samples = events['sample'].to_numpy()
+        events = events[(samples >= before) & (samples - before + length <= abf_sample_count(abf))]
+        self.events = events.reset_index(drop=True)
+
+        # Event sweeps are numbered by their sample, and journaled apart from the file's sweeps
+        source = f"{filepath}#events"
+        self.abf_headers[source] = abf
+        self.event_windows[source] = (before, length)
+        load = self.make_channel_loader(source)
+
+        numbers = self.events['sample'].to_numpy()
+        data, scale = self.read_stored(source, [] if self.memory_budget else numbers)
+        for i, (number, time) in enumerate(zip(numbers, self.events['time'])):
+            sweep = Sweep(int(number), data[i] if len(data) else None, sample_rate=self.sample_rate, n_samples=length)
+            sweep.source = source
+            sweep.label = f"Event {i} ({time:.4f} s)"
+            sweep.channel_loader = load
+            self.add_to_cache(sweep, scale)
+            self.connect_sweep(sweep)
+            self.sweeps.append(sweep)
+
+        self.replay_journal(self.sweeps)
+        self.on_sweeps_changed.emit(self.sweeps)
+        self.on_load_complete.emit()
+        return self.events
+
+    def sample_matrix(self, indices=None):
+        """Stack the samples of the sweeps at `indices` into a (sweeps x samples) array
+        """
+        indices = range(len(self.sweeps)) if indices is None else indices
+        return np.stack([self.sweeps[i].data for i in indices])
+
+    def sample_tensor(self, channels, indices=None):
+        """Samples of the sweeps at `indices` for several channels, as a (channel x sweep x sample) array
+
+        The first channel is taken from memory; any others are read from the
+        source files, all selected channels of a file in one pass. With a
+        memory budget every channel is streamed from the files, so that large
+        reads do not evict the sweeps that are in use.
+        """
+        channels = list(channels)
+        indices = np.arange(len(self.sweeps)) if indices is None else np.asarray(indices)
+        in_files = all(self.sweeps[i].source in self.abf_headers for i in indices)
+        if channels == [0] and (self.memory_budget is None or not in_files):
+            return self.sample_matrix(indices)[None]
+
+        sources = np.array([self.sweeps[i].source for i in indices], dtype=object)
+        numbers = np.array([self.sweeps[i].number for i in indices], dtype=int)
+        tensor = np.empty((len(channels), len(indices), self.sweeps[indices[0]].n_samples), dtype=np.float32)
+        for source in dict.fromkeys(sources):
+            if source not in self.abf_headers:
+                raise Exception("Channels other than the first are only available for .abf files")
+            mask = sources == source
+            tensor[:, mask] = self.read_source(source, numbers[mask], channels)
+        return tensor
+
+    def sweep_blocks(self, indices, channels=(0,)):
+        """Yield the sweeps at `indices` as (block indices, channel x sweep x sample tensor)
+
+        Without a memory budget there is a single block, otherwise blocks are
+        sized so that their filtering temporaries fit within the budget.
+        """
+        indices = np.asarray(indices)
+        size = len(indices)
+        if self.memory_budget is not None and len(indices):
+            # Filtering makes several float64 and complex copies of a block
+            sweep_bytes = 8 * 8 * len(channels) * self.sweeps[indices[0]].n_samples
+            size = max(1, int(self.memory_budget // sweep_bytes))
+
+        for start in range(0, len(indices), max(size, 1)):
+            block = indices[start:start + size]
+            yield block, self.sample_tensor(channels, block)
+
+    def data_limits(self):
+        """Time and amplitude range of the first channel over all sweeps
+        """
+        ymin, ymax = np.inf, -np.inf
+        for _, block in self.sweep_blocks(np.arange(len(self.sweeps))):
+            ymin = min(ymin, block.min())
+            ymax = max(ymax, block.max())
+        n_samples = max(sweep.n_samples for sweep in self.sweeps)
+        return dict(xmin=0.0, xmax=(n_samples - 1) / self.sample_rate, ymin=float(ymin), ymax=float(ymax))
+
+    def update_features(self, indices=None):
+        """Recompute the feature table rows of the sweeps at `indices` with the current settings
+        """
+        indices = np.arange(len(self.sweeps)) if indices is None else np.asarray(indices)
+        table = pd.concat([
+            compute_features(
+                block[0], self.sample_rate, self.lowband, self.highband,
+                self.trigger_xmin, self.trigger_xmax, self.baseline_xmin, self.baseline_xmax)
+            for _, block in self.sweep_blocks(indices)], ignore_index=True)
+        table.index = indices
+        table.insert(0, 'file', [self.sweeps[i].source for i in indices])
+        table.insert(1, 'sweep_number', [self.sweeps[i].number for i in indices])
+
+        if self.features is None or len(indices) == len(self.sweeps):
+            self.features = table.sort_index()
+        elif len(self.features) == 0 or indices.min() > self.features.index[-1]:
+            # Sweeps appended to the session go after every row, no need to re-sort the table
+            self.features = pd.concat([self.features, table.sort_index()])
+        else:
+            self.features = pd.concat([self.features.drop(indices, errors='ignore'), table]).sort_index()
+        return table
+
+    def feature_positions(self, indices):
+        """Row positions of the sweeps at `indices` in the feature table, -1 for sweeps without a row
+
+        The table is sorted by sweep index, so rows are found by binary search
+        rather than by hashing the index of the whole session.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.features is None or len(self.features) == 0:
+            return np.full(len(indices), -1)
+        index = self.features.index.to_numpy()
+        positions = np.searchsorted(index, indices).clip(max=len(index) - 1)
+        return np.where(index[positions] == indices, positions, -1)
+
+    def feature_rows(self, indices=None):
+        """Feature table rows of the sweeps at `indices`, the whole table by default
+        """
+        if indices is None:
+            return self.features
+        positions = self.feature_positions(indices)
+        if (positions < 0).any():
+            raise KeyError("Features of some sweeps were not computed")
+        return self.features.iloc[positions]
+
+    def query(self, expr, indices=None, **params):
+        """Evaluate a boolean expression on the feature table, e.g. `query("peak > @y", y=10)`
+
+        Returns a boolean mask over the sweeps at `indices` (all sweeps by default).
+        """
+        return self.feature_rows(indices).eval(expr, local_dict=params).to_numpy(dtype=bool)
+
+    def make_detector(self) -> Detector:
+        """Build the selected detection engine from the current settings
+        """
+        if self.detector_name == 'bandpass':
+            return BandpassThresholdDetector(self.lowband, self.highband, self.trigger_xmin, self.trigger_xmax, self.trigger_ysmoothed)
+        elif self.detector_name == 'dvdt':
+            return DerivativeThresholdDetector(self.lowband, self.highband, self.trigger_xmin, self.trigger_xmax, self.dvdt_threshold)
+        elif self.detector_name == 'template':
+            if self.template_sweep_index is None:
+                raise Exception("Select a template sweep first")
+            if not 0 <= self.template_sweep_index < len(self.sweeps):
+                raise Exception(f"Template sweep {self.template_sweep_index} is not loaded yet")
+            template = self.sample_tensor(self.detection_channels, [self.template_sweep_index])
+            return TemplateDetector(template, self.lowband, self.highband, self.trigger_xmin, self.trigger_xmax, self.template_threshold)
+        elif self.detector_name == 'cluster':
+            return ClusterDetector(self.lowband, self.highband, self.trigger_xmin, self.trigger_xmax,
+                n_clusters=self.n_clusters, fit=self.cluster_fit)
+        else:
+            raise Exception(f"Unknown detector '{self.detector_name}'")
+
+    def review_order(self):
+        """Indices of the sweeps in the order they should be listed for review
+
+        When ordering by confidence the least certain sweeps come first, and
+        sweeps that were not scored are listed last.
+        """
+        if not self.order_by_confidence or len(self.confidence) != len(self.sweeps):
+            return np.arange(len(self.sweeps))
+
+        return np.argsort(np.nan_to_num(self.confidence, nan=np.inf), kind='stable')
+
+    def assign_groups(self, indices, groups, user):
+        """Set the group and moved-by-user flag (one for all, or one per sweep) of the sweeps at `indices`
+        """
+        sweeps = [self.sweeps[i] for i in indices]
+        for sweep, group, moved in zip(sweeps, groups, np.broadcast_to(user, len(sweeps))):
+            sweep._group = SignalGroup(int(group))
+            sweep.was_moved_by_user = bool(moved)
+        self.record_groups(sweeps)
+
+    def set_groups(self, indices, groups, user=False):
+        """Set the group of the sweeps at `indices` to the matching `groups` values in one step
+
+        Emits a single `on_sweeps_changed` rather than one per sweep.
+        """
+        self.assign_groups(indices, groups, user)
+        self.on_sweeps_changed.emit(self.sweeps)
+
+    def group_state(self, indices):
+        """(indices, group values, moved by user) arrays of the sweeps at `indices`
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        groups = np.fromiter((self.sweeps[i]._group.value for i in indices), dtype=np.uint8, count=len(indices))
+        moved = np.fromiter((self.sweeps[i].was_moved_by_user for i in indices), dtype=bool, count=len(indices))
+        return indices, groups, moved
+
+    def move_sweeps(self, indices, group: SignalGroup):
+        """Move the sweeps at `indices` to `group` as one undoable step by the user
+
+        Sweeps already in `group` are left alone. Emits `on_groups_changed` with
+        the indices that moved, and returns them.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = indices[[self.sweeps[i]._group != group for i in indices]] if len(indices) else indices
+        if len(indices) == 0:
+            return indices
+
+        self.undo_stack.append(self.group_state(indices))
+        del self.undo_stack[:-self.undo_limit]
+        self.redo_stack = []
+        self.assign_groups(indices, np.full(len(indices), group.value), user=True)
+        self.on_groups_changed.emit(indices)
+        return indices
+
+    def move_by_score(self, threshold, above, group: SignalGroup):
+        """Move every scored sweep whose score is above (or below) `threshold` to `group`
+        """
+        scores = np.asarray(self.scores, dtype=float)
+        with np.errstate(invalid='ignore'):
+            selected = scores > threshold if above else scores < threshold
+        return self.move_sweeps(np.flatnonzero(selected), group)
+
+    def restore_groups(self, undo_from, redo_to):
+        """Pop a step from one stack, push the current state of its sweeps to the other and restore it
+        """
+        if len(undo_from) == 0:
+            return None
+        indices, groups, moved = undo_from.pop()
+        redo_to.append(self.group_state(indices))
+        self.assign_groups(indices, groups, moved)
+        self.on_groups_changed.emit(indices)
+        return indices
+
+    def undo(self):
+        """Revert the last move, returns the indices of the sweeps it moved back (None if there is none)
+        """
+        return self.restore_groups(self.undo_stack, self.redo_stack)
+
+    def redo(self):
+        return self.restore_groups(self.redo_stack, self.undo_stack)
+
+    def grow_scores(self):
+        """Extend `scores` and `confidence` with nan up to the number of sweeps
+
+        They are views of a larger storage that doubles when full, so appending
+        a few sweeps at a time does not copy the scores of the whole session.
+        """
+        n, n_scored = len(self.sweeps), len(self.scores)
+        if n_scored >= n:
+            return
+
+        storage = self._score_storage
+        if storage.shape[1] < n or self.scores.base is not storage:
+            storage = np.empty((2, max(n, 2 * storage.shape[1])))
+            storage[0, :n_scored] = self.scores
+            storage[1, :n_scored] = self.confidence
+            self._score_storage = storage
+        storage[:, n_scored:n] = np.nan
+        self.scores = storage[0, :n]
+        self.confidence = storage[1, :n]
+
+    def autosort(self, indices=None):
+        """Sort sweeps with the selected detector
+
+        With several detection channels a sweep is activity if any (or all,
+        see `channel_rule`) of its channels are. Sweeps that were moved by the
+        user keep their group. Sorting all sweeps re-fits the clustering engine,
+        sorting some (e.g. new sweeps in watch mode) assigns them to its clusters.
+        """
+        refit = indices is None
+        indices = np.arange(len(self.sweeps)) if indices is None else np.asarray(indices)
+        indices = np.array([i for i in indices if not self.sweeps[i].was_moved_by_user], dtype=int)
+        self.grow_scores()
+        if len(indices) == 0:
+            return
+
+        detector = self.make_detector()
+        if isinstance(detector, ClusterDetector) and refit:
+            detector.fitted = None
+        if isinstance(detector, FeatureThresholdDetector) and self.detection_channels == [0]:
+            # Threshold engines on the first channel are queries on the feature table
+            table = self.update_features(indices)
+            is_activity = self.query(detector.query, indices, threshold=detector.threshold)
+            scores = table[detector.column].to_numpy(dtype=float)
+        else:
+            # One batched pass over every selected channel (per block that fits the
+            # memory budget), then combine per sweep
+            features = np.concatenate([
+                detector.features(block, self.sample_rate)
+                for _, block in self.sweep_blocks(indices, self.detection_channels)], axis=1)
+            groups, scores = detector.classify(features)
+            if isinstance(detector, ClusterDetector):
+                self.cluster_fit = detector.fitted
+            is_activity = groups == SignalGroup.ACTIVITY.value
+            if self.channel_rule == 'all':
+                is_activity = is_activity.all(axis=0)
+                scores = scores.min(axis=0)
+            else:
+                is_activity = is_activity.any(axis=0)
+                scores = scores.max(axis=0)
+        groups = np.where(is_activity, SignalGroup.ACTIVITY.value, SignalGroup.NOISE.value)
+
+        self.scores[indices] = scores
+        self.confidence[indices] = detector.confidence(scores)
+        self.assign_groups(indices, groups, user=False)
+        if self.order_by_confidence:
+            # New confidences change the review order of the whole list
+            self.on_sweeps_changed.emit(self.sweeps)
+        else:
+            self.on_groups_changed.emit(indices)
         self.on_signal_detect_complete.emit()
 
+    def feature_export(self, indices=None):
+        """Feature table rows with the current group of each sweep
+        """
+        table = self.feature_rows(indices)
+        return table.assign(group=[self.sweeps[i].group.name for i in table.index])
+
+    def save_incremental(self, save_location, indices):
+        """Append the features and groups of the sweeps at `indices` to `session_sweeps.csv`
+
+        Feature rows that `autosort` already computed for these sweeps are reused.
+        """
+        outfile = Path(save_location) / "session_sweeps.csv"
+        indices = np.asarray(indices)
+        missing = indices[self.feature_positions(indices) < 0]
+        if len(missing):
+            self.update_features(missing)
+        self.feature_export(indices).to_csv(outfile, mode='a', header=not outfile.exists(), index=False)
+
+    def resume_incremental(self, save_location):
+        """Count the sweeps already in `session_sweeps.csv` as seen, so that they are not written again
+        """
+        outfile = Path(save_location) / "session_sweeps.csv"
+        if not outfile.exists():
+            return
+
+        written = pd.read_csv(outfile, usecols=['file', 'sweep_number'])
+        for source, number in written.groupby('file')['sweep_number'].max().items():
+            source = str(Path(source).resolve())
+            self.sweeps_seen[source] = max(self.sweeps_seen.get(source, 0), int(number) + 1)
+
     def save(self, save_location):
         self._save_location = save_location
 
         load_location = Path(self._file_location)
         save_location = Path(self._save_location)
         fname = load_location.parts[-1].split('.')[0]
-        data = np.stack([sweep.data for sweep in self.sweeps if sweep.group == SignalGroup.ACTIVITY])
+        activity = np.array([i for i, sweep in enumerate(self.sweeps) if sweep.group == SignalGroup.ACTIVITY], dtype=int)
+        if len(activity) == 0:
+            raise Exception("There are no activity sweeps to save")
+
+        # Written a block of sweeps at a time, so saving stays within the memory budget
+        max_value = max(np.abs(block).max() for _, block in self.sweep_blocks(activity))
         outfile = save_location / f"{fname}_signals.abf"
-        pyabf.abfWriter.writeABF1(data, outfile, self.sample_rate)
-        
+        write_abf1(outfile, (block[0] for _, block in self.sweep_blocks(activity)),
+            len(activity), self.sweeps[activity[0]].n_samples, self.sample_rate, max_value)
+
+        # Sweeps of .abf files are stored as references to them rather than as samples
         data = {
             'meta': {
                 'sample_rate': int(self.sample_rate),
                 'out_file': str(outfile),
-                'original_file': str(self._file_location)
+                'original_file': str(self._file_location),
+                'event_windows': {source: list(window) for source, window in self.event_windows.items()}
             },
-            'data': [s.to_dict() for s in self.sweeps]
+            'data': [s.to_dict(samples=s.source not in self.abf_headers) for s in self.sweeps]
         }
         with open(save_location / f"{fname}_signals.pkl", 'wb') as fp:
-            pickle.dump(data, fp)
\ No newline at end of file
+            pickle.dump(data, fp)
+
+        self.update_features()
+        self.feature_export().to_csv(save_location / f"{fname}_features.csv", index=False)
+
+        if self.events is not None:
+            groups = [sweep.group.name for sweep in self.sweeps]
+            self.events.assign(group=groups).to_csv(save_location / f"{fname}_events.csv", index=False)
+
+class FolderWatcher(QObject):
+    """Poll a folder for new or grown .abf files and sort the new sweeps
+
+    Each new sweep is appended to the model, sorted with the model's current
+    settings and, if `save_location` is set, written to the session outputs.
+    Call `poll` from a timer, or `run` to block (headless mode).
+    """
+    on_file_processed = QtCore.pyqtSignal(str, int)
+
+    def __init__(self, model: Model, folder, save_location=None):
+        super().__init__()
+        self.model = model
+        self.folder = Path(folder).resolve()
+        self.save_location = save_location
+        self._file_sizes = {}
+
+        # Session indices of sweeps appended from each file that are not yet sorted and saved
+        self._pending = {}
+        self.model.on_session_cleared.connect(self.reset)
+
+    def reset(self):
+        """Forget what was processed, the model started a new session
+        """
+        self._file_sizes = {}
+        self._pending = {}
+
+    def modified_files(self):
+        """(path, size) of the .abf files in the folder, oldest first, skipping files removed meanwhile
+        """
+        files = []
+        for filepath in self.folder.glob('*.abf'):
+            try:
+                stat = filepath.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, filepath, stat.st_size))
+        return [(filepath, size) for _, filepath, size in sorted(files)]
+
+    def poll(self):
+        """Process every file that changed since the last poll, returns the number of new sweeps
+
+        A file whose sweeps could not be read, sorted or saved is tried again on
+        the next poll.
+        """
+        total = 0
+        for filepath, size in self.modified_files():
+            if self._file_sizes.get(filepath) == size and filepath not in self._pending:
+                continue
+
+            try:
+                sweeps = self.model.append_file(filepath)
+            except Exception as e:
+                # The header may not be written yet, retry on the next poll
+                print(f"Could not read '{filepath}': {e}")
+                continue
+
+            new = np.arange(len(self.model.sweeps) - len(sweeps), len(self.model.sweeps))
+            indices = np.concatenate([self._pending.pop(filepath, np.array([], dtype=int)), new])
+            if len(indices) == 0:
+                self._file_sizes[filepath] = size
+                continue
+
+            try:
+                self.model.autosort(indices)
+                if self.save_location:
+                    self.model.save_incremental(self.save_location, indices)
+            except Exception as e:
+                print(f"Could not sort '{filepath}', retrying on the next poll: {e}")
+                self._pending[filepath] = indices
+                continue
+
+            self._file_sizes[filepath] = size
+            total += len(indices)
+            self.on_file_processed.emit(str(filepath), len(indices))
+
+        return total
+
+    def run(self, interval=5.0):
+        try:
+            while True:
+                self.poll()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass